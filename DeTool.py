@@ -4,6 +4,7 @@
 #Type: postprocess
 #Param: sdcard_param(float:0) Compress for SD card printing
 #Param: toolTravelSpeed(float:0) Tool change travel speed (mm/s)
+#Param: optimize_travel_param(float:0) Merge tool change travel moves
 #Param: t0extruder(string:0) T0 PhysicalExtruder (empty=none)
 #Param: t1extruder(string:1) T1 PhysicalExtruder (empty=none)
 #Param: t2extruder(string:2) T2 PhysicalExtruder (empty=none)
@@ -52,6 +53,28 @@
 
 __copyright__ = "Copyright (C) 2013 Ambroz Bizjak - Released under the BSD 2-clause license"
 
+import os
+import re
+import stat
+import tempfile
+import contextlib
+import timeit
+import sys
+
+OutputBufferSize = 2**16
+ParallelChunkSize = 2**22
+BatchExtension = '.gcode'
+BatchManifestName = '.DeTool-batch.json'
+
+# For DeTool.scan_chunk(): lines other than G0/G1, blank lines and comments,
+# and lines mentioning DeTool, which may be a marker. With optimizeTravel, also
+# moves without an axis, which count in travelStats.
+_ScanSpecial = re.compile(r'^(?![ ]*(?:G[01](?:[ \r]|$)|;|\r?$)).*|^.*DeTool.*', re.M)
+_ScanSpecialTravel = re.compile(r'^(?![ ]*(?:G[01](?:[ \r]|$)|;|\r?$)).*|^.*DeTool.*|^[ ]*G[01](?:[ ]+F\S*)*[ ]*\r?(?:;.*)?$', re.M)
+_ScanComment = re.compile(r';.*')
+_ScanWord = re.compile(r'\S*')
+_ScanAxes = ('X', 'Y', 'Z', 'E', 'F')
+
 def replace_multi(subject, match, replace):
     assert sum([len(m) == 0 for m in match]) == 0
     assert len(replace) == len(match)
@@ -71,41 +94,919 @@ def replace_multi(subject, match, replace):
         pos = nearest_pos + len(match[nearest_match])
     return ''.join(result)
 
-physicalExtruders = {}
-tools = {}
+class MultiReplace(object):
+    # Same result as replace_multi(), with all patterns compiled into one
+    # regular expression, whose alternation also prefers the first of the
+    # patterns matching at the same position. Subjects not containing the
+    # first character of any pattern are returned without searching.
+    def __init__(self, match, replace):
+        assert sum([len(m) == 0 for m in match]) == 0
+        assert len(replace) == len(match)
+        self.replacements = {}
+        for (m, r) in zip(match, replace):
+            self.replacements.setdefault(m, r)
+        self.firstChars = tuple(set(m[0] for m in match))
+        self.regex = re.compile('|'.join(re.escape(m) for m in match)) if len(match) > 0 else None
+    
+    def __call__(self, subject):
+        for c in self.firstChars:
+            if c in subject:
+                return self.regex.sub(self._replacement, subject)
+        return subject
+    
+    def _replacement(self, match):
+        return self.replacements[match.group(0)]
 
-if 'filename' in locals():
-    physicalExtruders[0] = {'name':axis0, 'offsets':{'X':offset0X, 'Y':offset0Y, 'Z':offset0Z}, 'fan':fan0, 'fan_multiplier':fan_multiplier0}
-    physicalExtruders[1] = {'name':axis1, 'offsets':{'X':offset1X, 'Y':offset1Y, 'Z':offset1Z}, 'fan':fan1, 'fan_multiplier':fan_multiplier1}
-    physicalExtruders[2] = {'name':axis2, 'offsets':{'X':offset2X, 'Y':offset2Y, 'Z':offset2Z}, 'fan':fan2, 'fan_multiplier':fan_multiplier2}
+class DeToolConfig(object):
+    # The printer setup. Tools maps tool indices to physical extruders, which
+    # are dicts with the axis 'name', the 'offsets' added to X/Y/Z, and the
+    # 'fan' command ('' for none) with its 'fan_multiplier'.
     
-    if t0extruder:
-        tools[0] = physicalExtruders[int(t0extruder)]
-    if t1extruder:
-        tools[1] = physicalExtruders[int(t1extruder)]
-    if t2extruder:
-        tools[2] = physicalExtruders[int(t2extruder)]
+    __slots__ = ('tools', 'toolTravelSpeed', 'sdcard', 'optimizeTravel')
+    
+    def __init__(self, tools, toolTravelSpeed, sdcard=False, optimizeTravel=False):
+        if len(tools) == 0:
+            raise Exception('No tools defined')
+        self.tools = tools
+        self.toolTravelSpeed = toolTravelSpeed
+        self.sdcard = sdcard
+        self.optimizeTravel = optimizeTravel
+
+class DeToolState(object):
+    # Everything carried from one line to the next.
+    
+    __slots__ = ('tool', 'relative', 'physPos', 'reqPos', 'known', 'pending', 'feedrate', 'fanSpeed', 'ignore', 'printerF', 'travelDeferred')
+    
+    def __init__(self, tool):
+        self.tool = tool
+        self.relative = False
+        self.physPos = {'X':0.0, 'Y':0.0, 'Z':0.0}
+        self.reqPos = {'X':0.0, 'Y':0.0, 'Z':0.0, 'E':0.0}
+        self.known = {'X':False, 'Y':False, 'Z':False}
+        self.pending = {'X':False, 'Y':False, 'Z':False}
+        self.feedrate = 999999.0
+        self.fanSpeed = 0.0
+        self.ignore = False
+        # With optimizeTravel: the feedrate last sent, and whether the travel
+        # after a tool change was put off by a move without X/Y/Z.
+        self.printerF = self.feedrate
+        self.travelDeferred = False
+    
+    def copy(self):
+        state = DeToolState(self.tool)
+        state.relative = self.relative
+        state.physPos = self.physPos.copy()
+        state.reqPos = self.reqPos.copy()
+        state.known = self.known.copy()
+        state.pending = self.pending.copy()
+        state.feedrate = self.feedrate
+        state.fanSpeed = self.fanSpeed
+        state.ignore = self.ignore
+        state.printerF = self.printerF
+        state.travelDeferred = self.travelDeferred
+        return state
+
+class DeTool(object):
+    # The tool-state transformer. One instance can process any number of
+    # files with the same configuration, each with its own DeToolState.
+    
+    def __init__(self, config):
+        self.config = config
+        self.tools = config.tools
+        self.sdcard = config.sdcard
+        self.optimizeTravel = config.optimizeTravel
+        # What optimizeTravel saved: separate tool change travels merged into
+        # other moves, feedrate-only lines, and moves which move nothing.
+        self.travelStats = {'removedTravels': 0, 'removedFeedrateLines': 0, 'removedMoves': 0}
+        substMatch = ['{T%sAxis}' % (i) for i in self.tools] + ['?T%sAxis?' % (i) for i in self.tools]
+        substReplace = [self.tools[i]['name'] for i in self.tools] + [self.tools[i]['name'] for i in self.tools]
+        self.substitute = MultiReplace(substMatch, substReplace)
+        self.handlers = {
+            'G28': self._home,
+            'G90': self._absolute,
+            'G91': self._relative,
+            'G92': self._set_position,
+            'M106': self._fan,
+            'M107': self._fan,
+            'G0': self._move,
+            'G1': self._move,
+        }
+        self.scanHandlers = dict(self.handlers)
+        self.scanHandlers['G0'] = self._scan_move
+        self.scanHandlers['G1'] = self._scan_move
+    
+    def new_state(self):
+        return DeToolState(min(self.tools.keys()))
+    
+    def process(self, lines, state=None):
+        # Yields the output text for the lines, starting with the init
+        # sequence and ending with the end marker.
+        if state is None:
+            state = self.new_state()
+        yield self.header(state)
+        process_line = self.process_line
+        for line in lines:
+            newLine = process_line(state, line)
+            if newLine:
+                yield newLine
+        yield self.footer()
+    
+    def header(self, state):
+        tools = self.tools
+        newLine = ''
+        if not self.sdcard:
+            newLine += ';DeTool init\n'
+        newLine += 'G90\n'
+        for tool in tools:
+            newLine += 'G92 %s%.5f\n' % (tools[tool]['name'], state.reqPos['E'])
+        newLine += 'G0 F%.1f\n' % (state.feedrate)
+        if tools[state.tool]['fan']:
+            newLine += '%s S%.2f\n' % (tools[state.tool]['fan'], state.fanSpeed * tools[state.tool]['fan_multiplier'])
+        if not self.sdcard:
+            newLine += ';DeTool init end\n'
+        return newLine
+    
+    def footer(self):
+        return 'EOF\n' if self.sdcard else ';DeTool end\n'
+    
+    def scan_line(self, state, line):
+        # Only updates the state for the line, which is much faster for moves.
+        self.process_line(state, line, self.scanHandlers)
+    
+    def scan_chunk(self, state, data):
+        # Same as scan_line() for each line of data. Between the lines which
+        # can change more than the position (see _scan_special), there are
+        # runs of G0/G1 and comments. If the moves are absolute and there is
+        # no pending offset, only the last value of each axis in a run counts,
+        # and the run is not parsed at all.
+        if '\v' in data or '\f' in data or self.substitute(data) != data:
+            for line in data.split('\n'):
+                self.scan_line(state, line)
+            return
+        if '\t' in data:
+            data = data.replace('\t', ' ')
+        special = _ScanSpecialTravel if self.optimizeTravel else _ScanSpecial
+        pos = 0
+        for match in special.finditer(data):
+            self._scan_run(state, data[pos:match.start()])
+            self.scan_line(state, match.group(0))
+            pos = match.end()
+        self._scan_run(state, data[pos:])
     
-    inputFileName = filename
-    outputFileName = filename
-    sdcard = (sdcard_param != 0.0)
+    def _scan_run(self, state, run):
+        if state.ignore or len(run) == 0:
+            return
+        if state.relative or True in state.pending.values():
+            lines = run.split('\n')
+            for i in range(len(lines)):
+                if not (state.relative or True in state.pending.values()):
+                    run = '\n'.join(lines[i:])
+                    break
+                self.scan_line(state, lines[i])
+            else:
+                return
+        if ';' in run:
+            run = _ScanComment.sub('', run)
+        offsets = self.tools[state.tool]['offsets']
+        for axisName in _ScanAxes:
+            wordPos = run.rfind(' ' + axisName)
+            if wordPos < 0:
+                continue
+            value = float(_ScanWord.match(run, wordPos + 2).group(0))
+            if axisName == 'F':
+                state.feedrate = value
+                continue
+            state.reqPos[axisName] = value
+            if axisName != 'E':
+                state.physPos[axisName] = value + offsets[axisName]
+                state.known[axisName] = True
+        # With optimizeTravel, moves without an axis are special, so the last
+        # move here sent the feedrate.
+        if self.optimizeTravel and 'G' in run:
+            state.printerF = state.feedrate
     
-else:
+    def process_line(self, state, line, handlers=None):
+        # Returns the output text for one input line. Handlers return None
+        # to pass the line through.
+        if handlers is None:
+            handlers = self.handlers
+        sdcard = self.sdcard
+        line = line.strip()
+        line = self.substitute(line)
+        commentPos = line.find(';')
+        if commentPos < 0:
+            dataLine = line
+            commentLine = ''
+        else:
+            dataLine = line[:commentPos]
+            commentLine = line[commentPos:]
+        oldIgnore = state.ignore
+        keep = False
+        # The markers need only be looked for if there is a comment.
+        if commentLine:
+            if commentLine.find('DeToolIgnoreSection') >= 0:
+                state.ignore = True
+            elif commentLine.find('DeToolEndIgnoreSection') >= 0:
+                state.ignore = False
+            keep = commentLine.find('DeToolKeep') >= 0
+        comps = dataLine.split()
+        if len(comps) == 0 or oldIgnore or keep:
+            if not sdcard or len(comps) != 0:
+                return (dataLine if sdcard else line) + '\n'
+            return ''
+        handler = handlers.get(comps[0])
+        if handler is None and comps[0].startswith('T'):
+            handler = self._tool_change
+        if handler is not None:
+            newLine = handler(state, comps)
+            if newLine is not None:
+                return newLine
+        return (dataLine if sdcard else line) + '\n'
+    
+    def _tool_change(self, state, comps):
+        tools = self.tools
+        newLine = ''
+        toolStr = comps[0][1:]
+        if not (toolStr.isdigit() and int(toolStr) in tools):
+            raise Exception('Invalid tool in T command')
+        newTool = int(toolStr)
+        if newTool != state.tool:
+            toolName = tools[newTool]['name']
+            if not self.sdcard:
+                newLine += ';DeTool switch to tool %s (%s)\n' % (newTool, toolName)
+            newLine += 'G92 %s%.5f\n' % (toolName, state.reqPos['E'])
+            for axisName in state.physPos:
+                if not state.known[axisName]:
+                    raise Exception('Got tool change while position is unknown')
+                state.pending[axisName] = True
+            if tools[state.tool]['fan']:
+                newLine += '%s S0\n' % (tools[state.tool]['fan'])
+            if tools[newTool]['fan']:
+                newLine += '%s S%.2f\n' % (tools[newTool]['fan'], state.fanSpeed * tools[newTool]['fan_multiplier'])
+            if not self.sdcard:
+                newLine += ';DeTool switch end\n'
+            state.tool = newTool
+            state.travelDeferred = False
+        return newLine
+    
+    def _home(self, state, comps):
+        homeAxes = []
+        for i in range(1, len(comps)):
+            axisName = comps[i][0]
+            if not axisName in state.physPos:
+                raise Exception('Got G28 with unknown axis')
+            homeAxes.append(axisName)
+        if len(homeAxes) == 0:
+            homeAxes = state.physPos.keys()
+        for axisName in homeAxes:
+            state.known[axisName] = False
+            state.pending[axisName] = False
+        state.travelDeferred = False
+        return None
+    
+    def _absolute(self, state, comps):
+        state.relative = False
+        return '' if self.sdcard else ';DeTool absolute\n'
+    
+    def _relative(self, state, comps):
+        state.relative = True
+        return '' if self.sdcard else ';DeTool relative\n'
+    
+    def _set_position(self, state, comps):
+        tool = self.tools[state.tool]
+        currentPhysPos = state.physPos
+        currentReqPos = state.reqPos
+        currentKnown = state.known
+        newComps = [comps[0]]
+        for i in range(1, len(comps)):
+            comp = comps[i]
+            if len(comp) == 0 or not comp[0] in currentReqPos:
+                raise Exception('Got G92 with unknown axis')
+            axisName = comp[0]
+            value = float(comp[1:])
+            if axisName == 'E':
+                comp = '%s%.5f' % (tool['name'], value)
+            else:
+                if currentKnown[axisName]:
+                    currentPhysPos[axisName] += value - currentReqPos[axisName]
+                else:
+                    currentPhysPos[axisName] = value + tool['offsets'][axisName]
+                    currentKnown[axisName] = True
+                comp = '%s%.5f' % (axisName, currentPhysPos[axisName])
+            currentReqPos[axisName] = value
+            newComps.append(comp)
+        return '%s\n' % (' '.join(newComps))
+    
+    def _fan(self, state, comps):
+        for i in range(1, len(comps)):
+            comp = comps[i]
+            if comps[0] == 'M106' and len(comp) > 0 and comp[0] == 'S':
+                state.fanSpeed = float(comp[1:])
+            else:
+                raise Exception('Got unknown parameter in M106 or M107')
+        if comps[0] == 'M107':
+            state.fanSpeed = 0.0
+        tool = self.tools[state.tool]
+        if tool['fan']:
+            return '%s S%.2f\n' % (tool['fan'], state.fanSpeed * tool['fan_multiplier'])
+        return ''
+    
+    def _move(self, state, comps):
+        sdcard = self.sdcard
+        travelAxes, restoreF, merged, moveF, moveAxes = self._move_core(state, comps)
+        newLine = ''
+        if len(travelAxes) > 0:
+            if not sdcard:
+                newLine += ';DeTool travel after tool change\n'
+            newLine += 'G0 %s F%.1f\n' % (' '.join(['%s%.5f' % axis for axis in travelAxes]), self.config.toolTravelSpeed * 60.0)
+            if restoreF is not None:
+                newLine += 'G0 F%.1f\n' % (restoreF)
+            if not sdcard:
+                newLine += ';DeTool travel after tool change end\n'
+        elif merged:
+            if not sdcard:
+                newLine += ';DeTool merging tool change with G0\n'
+        if moveAxes is None:
+            return newLine
+        newLine += comps[0]
+        if moveF is not None:
+            newLine += ' F%.1f' % (moveF)
+        for axis in moveAxes:
+            newLine += ' %s%.5f' % axis
+        newLine += '\n'
+        return newLine
+    
+    def _scan_move(self, state, comps):
+        self._move_core(state, comps)
+        return ''
+    
+    def _move_core(self, state, comps):
+        # Updates the state for a G0/G1 and returns what to output: the
+        # (axis, position) pairs of a travel to apply a tool change offset
+        # first (if any) and the feedrate to restore after it (or None),
+        # whether the offset is instead merged into this move, the feedrate
+        # to set with this move (or None) and its (axis, position) pairs
+        # (None to leave the move out).
+        offsets = self.tools[state.tool]['offsets']
+        currentPhysPos = state.physPos
+        currentReqPos = state.reqPos
+        currentKnown = state.known
+        currentPending = state.pending
+        currentF = state.feedrate
+        newF, newReqPos, seenAxes = self._parse_move(state, comps)
+        physAxesSeen = len([axisName for axisName in seenAxes if axisName in currentPhysPos]) > 0
+        travel = False
+        merged = False
+        includePending = True
+        if not self.optimizeTravel:
+            if comps[0] == 'G1' or not physAxesSeen:
+                travel = True
+            else:
+                merged = sum(currentPending.values()) > 0
+        elif sum(currentPending.values()) > 0:
+            # The offset can wait past retracts and feedrate changes for a
+            # move which changes X/Y/Z, and goes into that move unless it is
+            # extruding; anything else extruding gets the travel first.
+            if not physAxesSeen and not ('E' in seenAxes and newReqPos['E'] > currentReqPos['E']):
+                includePending = False
+                state.travelDeferred = True
+            elif not physAxesSeen:
+                travel = True
+                state.travelDeferred = False
+            elif comps[0] == 'G0' or not 'E' in seenAxes:
+                merged = True
+                if comps[0] == 'G1' or state.travelDeferred:
+                    self.travelStats['removedTravels'] += 1
+                state.travelDeferred = False
+            else:
+                travel = True
+                state.travelDeferred = False
+        travelAxes = []
+        if travel:
+            for axisName in currentPhysPos:
+                if currentPending[axisName]:
+                    assert currentKnown[axisName]
+                    currentPhysPos[axisName] = currentReqPos[axisName] + offsets[axisName]
+                    currentPending[axisName] = False
+                    travelAxes.append((axisName, currentPhysPos[axisName]))
+        moveAxes = []
+        for axisName in currentReqPos:
+            if axisName in seenAxes or (axisName != 'E' and includePending and currentPending[axisName]):
+                axisReqPhysPos = newReqPos[axisName]
+                if axisName != 'E':
+                    axisReqPhysPos += offsets[axisName]
+                    currentPhysPos[axisName] = axisReqPhysPos
+                    currentPending[axisName] = False
+                    currentKnown[axisName] = True
+                    moveAxes.append((axisName, axisReqPhysPos))
+                else:
+                    moveAxes.append((self.tools[state.tool]['name'], axisReqPhysPos))
+        state.feedrate = newF
+        state.reqPos = newReqPos
+        if not self.optimizeTravel:
+            restoreF = currentF if len(travelAxes) > 0 else None
+            moveF = newF if newF != currentF else None
+            return (travelAxes, restoreF, merged, moveF, moveAxes)
+        # The feedrate is only sent with moves, when it differs from what the
+        # printer has; after a travel it is always sent again.
+        if len(travelAxes) > 0:
+            state.printerF = self.config.toolTravelSpeed * 60.0
+            self.travelStats['removedFeedrateLines'] += 1
+        if len(moveAxes) == 0:
+            if newF != currentF:
+                self.travelStats['removedFeedrateLines'] += 1
+            else:
+                self.travelStats['removedMoves'] += 1
+            return (travelAxes, None, merged, None, None)
+        moveF = None
+        if newF != state.printerF:
+            moveF = newF
+            state.printerF = newF
+        return (travelAxes, None, merged, moveF, moveAxes)
+    
+    def _parse_move(self, state, comps):
+        newF = state.feedrate
+        newReqPos = state.reqPos.copy()
+        seenAxes = []
+        for i in range(1, len(comps)):
+            comp = comps[i]
+            if len(comp) > 0 and comp[0] == 'F':
+                newF = float(comp[1:])
+            elif len(comp) > 0 and comp[0] in newReqPos:
+                if state.relative:
+                    if comp[0] != 'E' and not state.known[comp[0]]:
+                        raise Exception('Got relative move with axis whose position is unknown')
+                    newReqPos[comp[0]] += float(comp[1:])
+                else:
+                    newReqPos[comp[0]] = float(comp[1:])
+                seenAxes.append(comp[0])
+            else:
+                raise Exception('Unknown axis in G0 or G1')
+        return (newF, newReqPos, seenAxes)
+
+class PackedDeTool(DeTool):
+    # DeTool fused with aprinter_encode: moves go to a PacketWriter as
+    # numbers instead of being formatted as text and parsed again. The result
+    # is that of --sdcard followed by aprinter_encode.py, except that values
+    # are not rounded to the decimals of the text. The rest of the output is
+    # rare and encoded from its text.
+    
+    def __init__(self, config, writer):
+        DeTool.__init__(self, config)
+        self.sdcard = True
+        self.writer = writer
+        self.handlers['G0'] = self._packed_move
+        self.handlers['G1'] = self._packed_move
+    
+    def write(self, lines, state=None):
+        # Writes the packets for the lines, ending with the EOF packet.
+        if state is None:
+            state = self.new_state()
+        writer = self.writer
+        for textLine in self.header(state).split('\n'):
+            writer.write_line(textLine)
+        process_line = self.process_line
+        for line in lines:
+            newLine = process_line(state, line)
+            if newLine:
+                for textLine in newLine.split('\n'):
+                    writer.write_line(textLine)
+        writer.write_eof()
+    
+    def _packed_move(self, state, comps):
+        writer = self.writer
+        travelAxes, restoreF, merged, moveF, moveAxes = self._move_core(state, comps)
+        if len(travelAxes) > 0:
+            writer.write_command('G0', travelAxes + [('F', self.config.toolTravelSpeed * 60.0)])
+            if restoreF is not None:
+                writer.write_command('G0', [('F', restoreF)])
+        if moveAxes is not None:
+            if moveF is not None:
+                moveAxes.insert(0, ('F', moveF))
+            writer.write_command(comps[0], moveAxes)
+        return ''
+
+class DeToolProfile(object):
+    # Opt-in instrumentation of a DeTool instance: wraps its line processing
+    # and handlers to count lines by command and time them, and counts tool
+    # changes and how their offsets were applied. An uninstrumented DeTool
+    # pays nothing for this.
+
+    def __init__(self, deTool):
+        self.commands = {}
+        self.handlers = {}
+        self.toolChanges = 0
+        self.offsetTravels = 0
+        self.offsetMerges = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.seconds = 0.0
+        self._clock = timeit.default_timer
+        self._processLine = deTool.process_line
+        self._moveCore = deTool._move_core
+        self._toolChange = deTool._tool_change
+        deTool.process_line = self._process_line
+        deTool._move_core = self._move_core
+        deTool._tool_change = self._timed('tool_change', self._tool_change)
+        for command in deTool.handlers:
+            handler = deTool.handlers[command]
+            deTool.handlers[command] = self._timed(handler.__name__.lstrip('_'), handler)
+
+    def _process_line(self, state, line, handlers=None):
+        start = self._clock()
+        newLine = self._processLine(state, line, handlers)
+        elapsed = self._clock() - start
+        comps = line.split(';', 1)[0].split(None, 1)
+        if len(comps) == 0:
+            command = ';'
+        elif comps[0].startswith('T'):
+            command = 'T'
+        else:
+            command = comps[0]
+        entry = self.commands.get(command)
+        if entry is None:
+            entry = self.commands[command] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += elapsed
+        self.bytesIn += len(line)
+        return newLine
+
+    def _timed(self, name, handler):
+        entry = self.handlers.setdefault(name, [0, 0.0])
+        clock = self._clock
+        def timed(state, comps):
+            start = clock()
+            try:
+                return handler(state, comps)
+            finally:
+                entry[0] += 1
+                entry[1] += clock() - start
+        return timed
+
+    def _tool_change(self, state, comps):
+        oldTool = state.tool
+        newLine = self._toolChange(state, comps)
+        if state.tool != oldTool:
+            self.toolChanges += 1
+        return newLine
+
+    def _move_core(self, state, comps):
+        result = self._moveCore(state, comps)
+        if len(result[0]) > 0:
+            self.offsetTravels += 1
+        elif result[2]:
+            self.offsetMerges += 1
+        return result
+
+    def lines(self):
+        return sum([entry[0] for entry in self.commands.values()])
+
+    def as_dict(self):
+        seconds = self.seconds if self.seconds > 0 else 1e-9
+        return {
+            'commands': dict([(command, {'lines': entry[0], 'seconds': entry[1]}) for (command, entry) in self.commands.items()]),
+            'handlers': dict([(name, {'calls': entry[0], 'seconds': entry[1]}) for (name, entry) in self.handlers.items()]),
+            'lines': self.lines(),
+            'toolChanges': self.toolChanges,
+            'offsetTravels': self.offsetTravels,
+            'offsetMerges': self.offsetMerges,
+            'bytesIn': self.bytesIn,
+            'bytesOut': self.bytesOut,
+            'seconds': self.seconds,
+            'linesPerSecond': self.lines() / seconds,
+            'bytesPerSecond': self.bytesIn / seconds,
+        }
+
+    def format_table(self):
+        # Commands and handlers by time spent, slowest first.
+        rows = ['%-14s %10s %10s %9s' % ('Command', 'Lines', 'Time (s)', 'us/line')]
+        for (command, entry) in sorted(self.commands.items(), key=lambda item: -item[1][1]):
+            rows.append('%-14s %10d %10.3f %9.2f' % (command, entry[0], entry[1], 1e6 * entry[1] / entry[0]))
+        rows.append('')
+        rows.append('%-14s %10s %10s %9s' % ('Handler', 'Calls', 'Time (s)', 'us/call'))
+        for (name, entry) in sorted(self.handlers.items(), key=lambda item: -item[1][1]):
+            if entry[0] > 0:
+                rows.append('%-14s %10d %10.3f %9.2f' % (name, entry[0], entry[1], 1e6 * entry[1] / entry[0]))
+        stats = self.as_dict()
+        rows.append('')
+        rows.append('Tool changes: %d (offset applied by %d travels, %d merges)' % (self.toolChanges, self.offsetTravels, self.offsetMerges))
+        rows.append('Bytes: %d in, %d out' % (self.bytesIn, self.bytesOut))
+        rows.append('Throughput: %.0f lines/s, %.2f MB/s in %.3f s' % (stats['linesPerSecond'], stats['bytesPerSecond'] / 1e6, self.seconds))
+        return '\n'.join(rows)
+
+def process(lines, config):
+    # Returns an iterator over the output text for the input lines.
+    return DeTool(config).process(lines)
+
+def read_lines(inputFileName):
+    # The line source: reads the input incrementally, so that memory use
+    # does not depend on the file size.
+    with open(inputFileName, "r") as f:
+        for line in f:
+            yield line
+
+def write_atomic(outputFileName, chunks, bufferSize=OutputBufferSize):
+    # The sink: collects output into large writes to the atomic output.
+    with atomic_output(outputFileName) as f:
+        pending = []
+        pendingSize = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            pendingSize += len(chunk)
+            if pendingSize >= bufferSize:
+                f.write(''.join(pending))
+                pending = []
+                pendingSize = 0
+        f.write(''.join(pending))
+
+@contextlib.contextmanager
+def atomic_output(outputFileName, mode="w"):
+    # Gives a temporary file next to the output, which replaces the output
+    # only when all is written. The input may therefore be the output (as in
+    # the Cura plugin), and an error leaves any existing output untouched.
+    outputDir = os.path.dirname(os.path.abspath(outputFileName))
+    fd, tempFileName = tempfile.mkstemp(prefix='.DeTool-', suffix='.tmp', dir=outputDir)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tempFileName, _new_file_mode(outputFileName))
+        if os.name == 'nt' and os.path.exists(outputFileName):
+            # No atomic replace on Windows.
+            os.remove(outputFileName)
+        os.rename(tempFileName, outputFileName)
+    except:
+        if os.path.exists(tempFileName):
+            os.remove(tempFileName)
+        raise
+
+def _new_file_mode(fileName):
+    if os.path.exists(fileName):
+        return stat.S_IMODE(os.stat(fileName).st_mode)
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def process_file(inputFileName, outputFileName, config, jobs=1, profile=False, estimator=None):
+    # Returns the DeTool used, for its statistics. With profile, the
+    # DeToolProfile is in its profile attribute (not with jobs > 1, where
+    # the lines are processed in other processes). An estimator from
+    # aprinter_estimate.py is given the moves as they are processed.
+    deTool = DeTool(config)
+    if profile:
+        if jobs > 1:
+            raise Exception('Profiling is not supported with multiple jobs')
+        deTool.profile = DeToolProfile(deTool)
+    if estimator is not None:
+        if jobs > 1:
+            raise Exception('Estimation is not supported with multiple jobs')
+        _attach_estimator(deTool, estimator)
+    start = timeit.default_timer()
+    if jobs > 1:
+        chunks = process_file_parallel(inputFileName, deTool, jobs)
+    else:
+        chunks = deTool.process(read_lines(inputFileName))
+    write_atomic(outputFileName, chunks)
+    if profile:
+        _finish_profile(deTool.profile, outputFileName, start)
+    if estimator is not None:
+        estimator.finish()
+    return deTool
+
+def process_file_packed(inputFileName, outputFileName, config, delta=False, profile=False, estimator=None):
+    # Writes packed g-code for the firmware's SD card reader directly (see
+    # PackedDeTool). Needs aprinter_encode.py next to this script.
+    import aprinter_encode
+    start = timeit.default_timer()
+    with atomic_output(outputFileName, "wb") as f:
+        writer = aprinter_encode.PacketWriter(f, delta=delta)
+        deTool = PackedDeTool(config, writer)
+        if profile:
+            deTool.profile = DeToolProfile(deTool)
+        if estimator is not None:
+            _attach_estimator(deTool, estimator)
+        deTool.write(read_lines(inputFileName))
+    if profile:
+        _finish_profile(deTool.profile, outputFileName, start)
+    if estimator is not None:
+        estimator.finish()
+    return deTool
+
+def estimate_file(inputFileName, config, estimator):
+    # Only runs the estimator, without producing output, which takes the
+    # faster scan path for moves.
+    deTool = DeTool(config)
+    _attach_estimator(deTool, estimator)
+    state = deTool.new_state()
+    scan_line = deTool.scan_line
+    for line in read_lines(inputFileName):
+        scan_line(state, line)
+    return estimator.finish()
+
+def _attach_estimator(deTool, estimator):
+    from aprinter_estimate import DeToolEstimate
+    DeToolEstimate(deTool, estimator)
+
+def _finish_profile(profile, outputFileName, start):
+    profile.seconds = timeit.default_timer() - start
+    profile.bytesOut = os.path.getsize(outputFileName)
+
+def process_file_parallel(inputFileName, deTool, jobs, chunkSize=ParallelChunkSize):
+    # Yields the same output as deTool.process() in two phases: a scan pass
+    # over the file records the state at the start of each chunk, and the
+    # chunks are then processed from their states in a pool of processes.
+    # The scan runs ahead while the pool works, and it is what updates the
+    # statistics of deTool.
+    import multiprocessing
+    from aprinter_encode import pool_imap
+    state = deTool.new_state()
+    yield deTool.header(state)
+    pool = multiprocessing.Pool(jobs)
+    # pool_imap() drains and joins the pool when a chunk fails or the
+    # output is not read to the end; terminating it could hang.
+    results = pool_imap(pool, _process_chunk, _scan_chunks(deTool, state, inputFileName, chunkSize), 2 * jobs)
+    try:
+        for text in results:
+            yield text
+    finally:
+        results.close()
+    yield deTool.footer()
+
+def _scan_chunks(deTool, state, inputFileName, chunkSize):
+    with open(inputFileName, "rb") as f:
+        boundaries = list(_split_at_lines(f, chunkSize))
+        f.seek(0)
+        for (start, end) in boundaries:
+            yield (inputFileName, start, end, deTool.config, state.copy())
+            deTool.scan_chunk(state, f.read(end - start))
+
+def _split_at_lines(f, chunkSize):
+    fileSize = os.fstat(f.fileno()).st_size
+    start = 0
+    while start < fileSize:
+        end = start + chunkSize
+        if end >= fileSize:
+            end = fileSize
+        else:
+            f.seek(end)
+            end += len(f.readline())
+        yield (start, end)
+        start = end
+
+def _process_chunk(task):
+    # Runs in a worker process.
+    inputFileName, start, end, config, state = task
+    with open(inputFileName, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    deTool = DeTool(config)
+    return ''.join([deTool.process_line(state, line) for line in lines])
+
+def batch_inputs(patterns):
+    # The input files of a batch: the .gcode files in directories and the
+    # files matching glob patterns, each once.
+    import glob
+    inputFileNames = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            fileNames = [os.path.join(pattern, name) for name in os.listdir(pattern) if name.lower().endswith(BatchExtension)]
+        else:
+            fileNames = glob.glob(pattern)
+        for fileName in sorted(fileNames):
+            if os.path.isfile(fileName) and not fileName in inputFileNames:
+                inputFileNames.append(fileName)
+    return inputFileNames
+
+def process_batch(inputFileNames, outputDir, config, jobs, packed=False, delta=False):
+    # Processes the files into outputDir, under the same names (ending in
+    # .packed with packed), in a pool of processes which stays up for the
+    # whole batch. A manifest in outputDir records the content hash of the
+    # input and the configuration of each output, and files for which both
+    # are unchanged are skipped. Returns (inputFileName, status, bytesIn,
+    # bytesOut, seconds, error) for each file, status being 'processed',
+    # 'unchanged' or 'failed'.
+    configHash = _batch_config_hash(config, packed, delta)
+    manifestFileName = os.path.join(outputDir, BatchManifestName)
+    manifest = _read_batch_manifest(manifestFileName)
+    tasks = []
+    outputNames = set()
+    for inputFileName in inputFileNames:
+        outputName = os.path.basename(inputFileName)
+        if packed:
+            outputName = os.path.splitext(outputName)[0] + '.packed'
+        if outputName in outputNames:
+            raise Exception('Batch inputs with the same name: %s' % (outputName))
+        outputNames.add(outputName)
+        outputFileName = os.path.join(outputDir, outputName)
+        entry = manifest.get(outputName)
+        knownHash = None
+        if entry is not None and entry.get('config') == configHash and os.path.exists(outputFileName):
+            knownHash = entry.get('input')
+        tasks.append((inputFileName, outputFileName, knownHash, config, packed, delta))
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(_process_batch_file, tasks, 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_process_batch_file(task) for task in tasks]
+    changed = False
+    for (task, result) in zip(tasks, results):
+        if result[1] == 'processed':
+            manifest[os.path.basename(task[1])] = {'input': result[6], 'config': configHash}
+            changed = True
+    if changed:
+        import json
+        with atomic_output(manifestFileName) as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return [result[:6] for result in results]
+
+def format_batch_summary(results, seconds):
+    counts = {'processed': 0, 'unchanged': 0, 'failed': 0}
+    bytesIn = 0
+    bytesOut = 0
+    for (inputFileName, status, fileBytesIn, fileBytesOut, fileSeconds, error) in results:
+        counts[status] += 1
+        bytesIn += fileBytesIn
+        bytesOut += fileBytesOut
+    return '%d files: %d processed, %d unchanged, %d failed; %.2f MB in, %.2f MB out in %.2f s (%.2f MB/s)' % (
+        len(results), counts['processed'], counts['unchanged'], counts['failed'],
+        bytesIn / 1e6, bytesOut / 1e6, seconds, bytesIn / 1e6 / max(seconds, 1e-9))
+
+def _process_batch_file(task):
+    # Runs in a worker process. Failures are returned rather than raised,
+    # so that one bad file does not stop the batch.
+    inputFileName, outputFileName, knownHash, config, packed, delta = task
+    start = timeit.default_timer()
+    try:
+        inputHash = _file_hash(inputFileName)
+        if inputHash == knownHash:
+            return (inputFileName, 'unchanged', 0, 0, 0.0, None, inputHash)
+        if packed:
+            process_file_packed(inputFileName, outputFileName, config, delta)
+        else:
+            process_file(inputFileName, outputFileName, config)
+        bytesIn = os.path.getsize(inputFileName)
+        bytesOut = os.path.getsize(outputFileName)
+    except Exception as e:
+        return (inputFileName, 'failed', 0, 0, timeit.default_timer() - start, str(e), None)
+    return (inputFileName, 'processed', bytesIn, bytesOut, timeit.default_timer() - start, None, inputHash)
+
+def _file_hash(fileName):
+    import hashlib
+    h = hashlib.sha1()
+    with open(fileName, "rb") as f:
+        while True:
+            block = f.read(OutputBufferSize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def _batch_config_hash(config, packed, delta):
+    import hashlib
+    import json
+    tools = dict([(str(tool), config.tools[tool]) for tool in config.tools])
+    key = [tools, config.toolTravelSpeed, config.sdcard, config.optimizeTravel, packed, delta]
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+def _read_batch_manifest(manifestFileName):
+    import json
+    if not os.path.exists(manifestFileName):
+        return {}
+    with open(manifestFileName, "r") as f:
+        return json.load(f)
+
+def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='GCode post-processor for APrinter firmware.')
-    parser.add_argument('--input', dest='input', metavar='InputFile', required=True)
-    parser.add_argument('--output', dest='output', metavar='OutputFile', required=True)
+    parser.add_argument('--input', dest='input', metavar='InputFile')
+    parser.add_argument('--output', dest='output', metavar='OutputFile')
+    parser.add_argument('--batch', dest='batch', action='append', metavar='DirOrGlob', help='Process the .gcode files in a directory, or the files matching a glob, into --output-dir.')
+    parser.add_argument('--output-dir', dest='output_dir', metavar='OutputDir', help='Output directory for --batch.')
     parser.add_argument('--tool-travel-speed', dest='tool_travel_speed', metavar='Speedmm/s', required=True)
     parser.add_argument('--physical', dest='physical', action='append', nargs=4, metavar=('AxisName', 'OffsetX', 'OffsetY', 'OffsetZ'), required=True)
     parser.add_argument('--tool', dest='tool', action='append', nargs=2, metavar=('ToolIndex', 'PhysicalIndexFrom0'), required=True)
     parser.add_argument('--fan', dest='fan', action='append', nargs=3, metavar=('FanSpeedCmd', 'PhysicalIndexFrom0', 'SpeedMultiplier'))
     parser.add_argument('--sdcard', dest='sdcard', action='store_true')
+    parser.add_argument('--jobs', dest='jobs', type=int, help='Number of processes (default 1, or the number of CPUs with --batch).')
+    parser.add_argument('--packed', dest='packed', action='store_true', help='Write packed g-code for SD printing (see aprinter_encode.py).')
+    parser.add_argument('--delta', dest='delta', action='store_true', help='With --packed, use delta encoding (needs decoder support).')
+    parser.add_argument('--optimize-travel', dest='optimize_travel', action='store_true', help='Merge tool change travels into other moves and leave out redundant feedrate lines.')
+    parser.add_argument('--stats', dest='stats', action='store_true', help='Count and time the lines by command and print a table.')
+    parser.add_argument('--stats-json', dest='stats_json', metavar='StatsFile', help='Write the statistics of --stats to this file as JSON (- for standard output).')
+    parser.add_argument('--estimate', dest='estimate', metavar='BoardMainFile', help='Estimate the print time and filament use with the axis limits from this main/*.cpp file (see aprinter_estimate.py). --output is then optional.')
+    parser.add_argument('--estimate-json', dest='estimate_json', metavar='EstimateFile', help='Write the estimate with the time of each layer to this file as JSON (- for standard output).')
     
     args = parser.parse_args()
-    inputFileName = args.input
-    outputFileName = args.output
-    toolTravelSpeed = float(args.tool_travel_speed)
+    physicalExtruders = {}
+    tools = {}
     for p in args.physical:
         physicalExtruders[len(physicalExtruders)] = {'name':p[0], 'offsets':{'X':float(p[1]), 'Y':float(p[2]), 'Z':float(p[3])}, 'fan':''}
     for t in args.tool:
@@ -120,198 +1021,111 @@ else:
                 raise Exception('Fan physical index is invalid')
             physicalExtruders[int(f[1])]['fan'] = f[0]
             physicalExtruders[int(f[1])]['fan_multiplier'] = float(f[2])
-    sdcard = bool(args.sdcard)
-
-with open(inputFileName, "r") as f:
-    lines = f.readlines()
-
-currentTool = min(tools.keys())
-currentRelative = False
-currentPhysPos = {'X':0.0, 'Y':0.0, 'Z':0.0}
-currentReqPos = {'X':0.0, 'Y':0.0, 'Z':0.0, 'E':0.0}
-currentKnown = {'X':False, 'Y':False, 'Z':False}
-currentPending = {'X':False, 'Y':False, 'Z':False}
-currentF = 999999.0
-currentFanSpeed = 0.0
-currentIgnore = False
-
-subst_match = ['{T%sAxis}' % (i) for i in tools] + ['?T%sAxis?' % (i) for i in tools]
-subst_replace = [tools[i]['name'] for i in tools] + [tools[i]['name'] for i in tools]
-
-with open(outputFileName, "w") as f:
-    if not sdcard:
-        f.write(';DeTool init\n')
-    f.write('G90\n')
-    for tool in tools:
-        f.write('G92 %s%.5f\n' % (tools[tool]['name'], currentReqPos['E']))
-    f.write('G0 F%.1f\n' % (currentF))
-    if tools[currentTool]['fan']:
-        f.write('%s S%.2f\n' % (tools[currentTool]['fan'], currentFanSpeed * tools[currentTool]['fan_multiplier']))
-    if not sdcard:
-        f.write(';DeTool init end\n')
-    
-    for line in lines:
-        line = line.strip()
-        line = replace_multi(line, subst_match, subst_replace)
-        commentPos = line.find(';')
-        if commentPos < 0:
-            commentPos = len(line)
-        dataLine = line[:commentPos]
-        commentLine = line[commentPos:]
-        oldIgnore = currentIgnore
-        if commentLine.find('DeToolIgnoreSection') >= 0:
-            currentIgnore = True
-        elif commentLine.find('DeToolEndIgnoreSection') >= 0:
-            currentIgnore = False
-        comps = dataLine.split()
-        newLine = (dataLine if sdcard else line) + '\n'
-        if len(comps) == 0 or oldIgnore or commentLine.find('DeToolKeep') >= 0:
-            if not sdcard or len(comps) != 0:
-                f.write(newLine)
-            continue
-        
-        if comps[0].startswith('T'):
-            newLine = ''
-            toolStr = comps[0][1:]
-            if not (toolStr.isdigit() and int(toolStr) in tools):
-                raise Exception('Invalid tool in T command')
-            newTool = int(toolStr)
-            if newTool != currentTool:
-                toolName = tools[newTool]['name']
-                if not sdcard:
-                    newLine += ';DeTool switch to tool %s (%s)\n' % (newTool, toolName)
-                newLine += 'G92 %s%.5f\n' % (toolName, currentReqPos['E'])
-                for axisName in currentPhysPos:
-                    if not currentKnown[axisName]:
-                        raise Exception('Got tool change while position is unknown')
-                    currentPending[axisName] = True
-                if tools[currentTool]['fan']:
-                    newLine += '%s S0\n' % (tools[currentTool]['fan'])
-                if tools[newTool]['fan']:
-                    newLine += '%s S%.2f\n' % (tools[newTool]['fan'], currentFanSpeed * tools[newTool]['fan_multiplier'])
-                if not sdcard:
-                    newLine += ';DeTool switch end\n'
-                currentTool = newTool
-            
-        elif comps[0] == 'G28':
-            homeAxes = []
-            for i in range(1, len(comps)):
-                axisName = comps[i][0]
-                if not axisName in currentPhysPos:
-                    raise Exception('Got G28 with unknown axis')
-                homeAxes.append(axisName)
-            if len(homeAxes) == 0:
-                homeAxes = currentPhysPos.keys()
-            for axisName in homeAxes:
-                currentKnown[axisName] = False
-                currentPending[axisName] = False
-            
-        elif comps[0] == 'G90':
-            currentRelative = False
-            newLine = ''
-            if not sdcard:
-                newLine = ';DeTool absolute\n'
-            
-        elif comps[0] == 'G91':
-            currentRelative = True
-            newLine = ''
-            if not sdcard:
-                newLine = ';DeTool relative\n'
-            
-        elif comps[0] == 'G92':
-            newComps = [comps[0]]
-            for i in range(1, len(comps)):
-                comp = comps[i]
-                if len(comp) == 0 or not comp[0] in currentReqPos:
-                    raise Exception('Got G92 with unknown axis')
-                axisName = comp[0]
-                value = float(comp[1:])
-                if axisName == 'E':
-                    comp = '%s%.5f' % (tools[currentTool]['name'], value)
-                else:
-                    if currentKnown[axisName]:
-                        currentPhysPos[axisName] += value - currentReqPos[axisName]
-                    else:
-                        currentPhysPos[axisName] = value + tools[currentTool]['offsets'][axisName]
-                        currentKnown[axisName] = True
-                    comp = '%s%.5f' % (axisName, currentPhysPos[axisName])
-                currentReqPos[axisName] = value
-                newComps.append(comp)
-            newLine = '%s\n' % (' '.join(newComps))
-        
-        elif comps[0] == 'M106' or comps[0] == 'M107':
-            for i in range(1, len(comps)):
-                comp = comps[i]
-                if comps[0] == 'M106' and len(comp) > 0 and comp[0] == 'S':
-                    currentFanSpeed = float(comp[1:])
-                else:
-                    raise Exception('Got unknown parameter in M106 or M107')
-            if comps[0] == 'M107':
-                currentFanSpeed = 0.0
-            newLine = ''
-            if tools[currentTool]['fan']:
-                newLine = '%s S%.2f\n' % (tools[currentTool]['fan'], currentFanSpeed * tools[currentTool]['fan_multiplier'])
-        
-        elif comps[0] == 'G0' or comps[0] == 'G1':
-            newLine = ''
-            newF = currentF
-            newReqPos = currentReqPos.copy()
-            seenAxes = []
-            for i in range(1, len(comps)):
-                comp = comps[i]
-                if len(comp) > 0 and comp[0] == 'F':
-                    newF = float(comp[1:])
-                elif len(comp) > 0 and comp[0] in currentReqPos:
-                    if currentRelative:
-                        if comp[0] != 'E' and not currentKnown[comp[0]]:
-                            raise Exception('Got relative move with axis whose position is unknown')
-                        newReqPos[comp[0]] += float(comp[1:])
-                    else:
-                        newReqPos[comp[0]] = float(comp[1:])
-                    seenAxes.append(comp[0])
-                else:
-                    raise Exception('Unknown axis in G0 or G1')
-            if comps[0] == 'G1' or len([axisName for axisName in seenAxes if axisName in currentPhysPos]) == 0:
-                pendingAxes = []
-                for axisName in currentPhysPos:
-                    if currentPending[axisName]:
-                        assert currentKnown[axisName]
-                        pendingAxes.append(axisName)
-                        currentPhysPos[axisName] = currentReqPos[axisName] + tools[currentTool]['offsets'][axisName]
-                        currentPending[axisName] = False
-                if len(pendingAxes) > 0:
-                    if not sdcard:
-                        newLine += ';DeTool travel after tool change\n'
-                    newLine += \
-                        'G0 %s F%.1f\n' % (' '.join(['%s%.5f' % (axisName, currentPhysPos[axisName]) for axisName in pendingAxes]), toolTravelSpeed * 60.0) + \
-                        'G0 F%.1f\n' % (currentF)
-                    if not sdcard:
-                        newLine += ';DeTool travel after tool change end\n'
-            elif sum(currentPending.values()) > 0:
-                if not sdcard:
-                    newLine += ';DeTool merging tool change with G0\n'
-            newLine += comps[0]
-            if newF != currentF:
-                newLine += ' F%.1f' % (newF)
-            for axisName in currentReqPos:
-                if axisName in seenAxes or (axisName != 'E' and currentPending[axisName]):
-                    axisCurrentPhysPos = currentPhysPos[axisName] if axisName != 'E' else currentReqPos[axisName]
-                    axisReqPhysPos = newReqPos[axisName]
-                    if axisName != 'E':
-                        axisReqPhysPos += tools[currentTool]['offsets'][axisName]
-                    realAxisName = axisName if axisName != 'E' else tools[currentTool]['name']
-                    newLine += ' %s%.5f' % (realAxisName, axisReqPhysPos)
-                    if axisName != 'E':
-                        currentPhysPos[axisName] = axisReqPhysPos
-                        currentPending[axisName] = False
-                        currentKnown[axisName] = True
-            currentF = newF
-            currentReqPos = newReqPos
-            newLine += '\n'
-        
-        f.write(newLine)
-        
-    if not sdcard:
-        f.write(';DeTool end\n')
-    if sdcard:
-        f.write('EOF\n')
+    if args.batch:
+        if args.input is not None or args.output is not None:
+            parser.error('--batch cannot be combined with --input and --output')
+        if args.output_dir is None:
+            parser.error('--batch requires --output-dir')
+        if args.stats or args.stats_json:
+            parser.error('--stats cannot be combined with --batch')
+        if args.estimate:
+            parser.error('--estimate cannot be combined with --batch')
+    elif args.input is None or (args.output is None and not args.estimate):
+        parser.error('--input and --output are required')
+    if args.estimate_json and not args.estimate:
+        parser.error('--estimate-json requires --estimate')
+    if args.jobs is None:
+        if args.batch:
+            import multiprocessing
+            args.jobs = multiprocessing.cpu_count()
+        else:
+            args.jobs = 1
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.batch:
+        if args.delta and not args.packed:
+            parser.error('--delta requires --packed')
+        config = DeToolConfig(tools, float(args.tool_travel_speed), bool(args.sdcard or args.packed), bool(args.optimize_travel))
+        inputFileNames = batch_inputs(args.batch)
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        start = timeit.default_timer()
+        results = process_batch(inputFileNames, args.output_dir, config, args.jobs, args.packed, args.delta)
+        failed = False
+        for (inputFileName, status, bytesIn, bytesOut, seconds, error) in results:
+            if status == 'failed':
+                print('%s: %s' % (inputFileName, error))
+                failed = True
+        print(format_batch_summary(results, timeit.default_timer() - start))
+        if failed:
+            sys.exit(1)
+        return
+    if args.packed and args.jobs != 1:
+        parser.error('--packed cannot be combined with --jobs')
+    if args.delta and not args.packed:
+        parser.error('--delta requires --packed')
+    profile = bool(args.stats or args.stats_json)
+    if profile and args.jobs != 1:
+        parser.error('--stats cannot be combined with --jobs')
+    if args.estimate and args.jobs != 1:
+        parser.error('--estimate cannot be combined with --jobs')
+    if profile and args.output is None:
+        parser.error('--stats requires --output')
+    config = DeToolConfig(tools, float(args.tool_travel_speed), bool(args.sdcard or args.packed), bool(args.optimize_travel))
+    estimator = None
+    if args.estimate:
+        import aprinter_estimate
+        estimator = aprinter_estimate.MoveEstimator(aprinter_estimate.read_board_limits(args.estimate),
+                                                    lookahead=aprinter_estimate.read_board_lookahead(args.estimate))
+    if args.output is None:
+        estimate_file(args.input, config, estimator)
+        deTool = None
+    elif args.packed:
+        deTool = process_file_packed(args.input, args.output, config, args.delta, profile, estimator)
+    else:
+        deTool = process_file(args.input, args.output, config, args.jobs, profile, estimator)
+    if estimator is not None:
+        print(estimator.format_summary())
+    if args.estimate_json:
+        import json
+        if args.estimate_json == '-':
+            print(json.dumps(estimator.as_dict(), indent=2, sort_keys=True))
+        else:
+            with open(args.estimate_json, "w") as f:
+                json.dump(estimator.as_dict(), f, indent=2, sort_keys=True)
+    if args.optimize_travel and deTool is not None:
+        stats = deTool.travelStats
+        print('Travel optimization removed {} lines: {} tool change travels, {} feedrate lines, {} empty moves'.format(
+            2 * stats['removedTravels'] + stats['removedFeedrateLines'] + stats['removedMoves'],
+            stats['removedTravels'], stats['removedFeedrateLines'], stats['removedMoves']))
+    if args.stats:
+        print(deTool.profile.format_table())
+    if args.stats_json:
+        import json
+        stats = deTool.profile.as_dict()
+        stats['travelStats'] = deTool.travelStats
+        if args.stats_json == '-':
+            print(json.dumps(stats, indent=2, sort_keys=True))
+        else:
+            with open(args.stats_json, "w") as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+
+if 'filename' in locals():
+    # Running as a Cura plugin, with the #Param values defined.
+    physicalExtruders = {}
+    physicalExtruders[0] = {'name':axis0, 'offsets':{'X':offset0X, 'Y':offset0Y, 'Z':offset0Z}, 'fan':fan0, 'fan_multiplier':fan_multiplier0}
+    physicalExtruders[1] = {'name':axis1, 'offsets':{'X':offset1X, 'Y':offset1Y, 'Z':offset1Z}, 'fan':fan1, 'fan_multiplier':fan_multiplier1}
+    physicalExtruders[2] = {'name':axis2, 'offsets':{'X':offset2X, 'Y':offset2Y, 'Z':offset2Z}, 'fan':fan2, 'fan_multiplier':fan_multiplier2}
+    
+    tools = {}
+    if t0extruder:
+        tools[0] = physicalExtruders[int(t0extruder)]
+    if t1extruder:
+        tools[1] = physicalExtruders[int(t1extruder)]
+    if t2extruder:
+        tools[2] = physicalExtruders[int(t2extruder)]
+    
+    process_file(filename, filename, DeToolConfig(tools, toolTravelSpeed, sdcard_param != 0.0, optimize_travel_param != 0.0))
+
+elif __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python2.7
+
+from __future__ import print_function
+from __future__ import with_statement
+import os
+import sys
+import io
+import time
+import json
+import random
+import tempfile
+import subprocess
+import aprinter_encode
+import aprinter_decode
+
+DefaultMix = 'G1=85,G0=5,retract=4,G92=1,M106=1,T=1,comment=3'
+
+def _best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def parse_mix(mix_text):
+    mix = []
+    for item in mix_text.split(','):
+        kind, weight = item.split('=')
+        if kind not in _CorpusWriters:
+            raise ValueError('Unknown command kind in mix: {}'.format(kind))
+        mix.append((kind, float(weight)))
+    return mix
+
+def generate_corpus(output_file, num_lines, mix, num_tools=2, seed=0):
+    # Writes slicer-like g-code which is also valid DeTool input: the
+    # position is known before the first tool change and tools are in
+    # range(num_tools).
+    rng = random.Random(seed)
+    state = {'x': 100.0, 'y': 100.0, 'z': 0.3, 'e': 0.0, 'tool': 0, 'num_tools': num_tools, 'layer': 0}
+    output_file.write('G21\nG90\nM82\nM107\nG28\nG92 E0\nG1 X100.000 Y100.000 Z0.300 F9000\n')
+    total_weight = sum(weight for (kind, weight) in mix)
+    written = 7
+    while written < num_lines:
+        point = rng.random() * total_weight
+        for (kind, weight) in mix:
+            point -= weight
+            if point < 0:
+                break
+        lines = _CorpusWriters[kind](rng, state)
+        output_file.write(lines)
+        written += lines.count('\n')
+
+def _corpus_move(rng, state):
+    state['x'] = min(200.0, max(0.0, state['x'] + rng.uniform(-5.0, 5.0)))
+    state['y'] = min(200.0, max(0.0, state['y'] + rng.uniform(-5.0, 5.0)))
+    state['e'] += rng.uniform(0.0, 0.3)
+    if rng.random() < 0.1:
+        return 'G1 F1800 X{:.3f} Y{:.3f} E{:.5f}\n'.format(state['x'], state['y'], state['e'])
+    return 'G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(state['x'], state['y'], state['e'])
+
+def _corpus_travel(rng, state):
+    state['x'] = rng.uniform(0.0, 200.0)
+    state['y'] = rng.uniform(0.0, 200.0)
+    return 'G0 F9000 X{:.3f} Y{:.3f}\n'.format(state['x'], state['y'])
+
+def _corpus_retract(rng, state):
+    return 'G1 F2400 E{:.5f}\n{}G1 F2400 E{:.5f}\n'.format(state['e'] - 4.5, _corpus_travel(rng, state), state['e'])
+
+def _corpus_reset_extruder(rng, state):
+    state['e'] = 0.0
+    return 'G92 E0\n'
+
+def _corpus_fan(rng, state):
+    return 'M106 S{}\n'.format(rng.choice((0, 127, 255)))
+
+def _corpus_tool_change(rng, state):
+    state['tool'] = (state['tool'] + 1) % state['num_tools']
+    return 'T{}\n'.format(state['tool'])
+
+def _corpus_comment(rng, state):
+    if rng.random() < 0.2:
+        state['layer'] += 1
+        state['z'] += 0.2
+        return ';LAYER:{}\nG0 Z{:.3f}\n'.format(state['layer'], state['z'])
+    return ';TYPE:{}\n'.format(rng.choice(('WALL-OUTER', 'WALL-INNER', 'FILL', 'SKIN')))
+
+_CorpusWriters = {
+    'G1': _corpus_move,
+    'G0': _corpus_travel,
+    'retract': _corpus_retract,
+    'G92': _corpus_reset_extruder,
+    'M106': _corpus_fan,
+    'T': _corpus_tool_change,
+    'comment': _corpus_comment,
+}
+
+def _suite_commands(corpus, work_dir, num_tools):
+    # Each benchmark is a command line, run as a child process so that its
+    # peak RSS can be measured on its own.
+    python = sys.executable
+    host_dir = os.path.dirname(os.path.realpath(__file__))
+    packed = os.path.join(work_dir, 'out.packed')
+    commands = [
+        ('encode_line', [python, os.path.realpath(__file__), 'encode-lines', '--input', corpus]),
+        ('encode_file', [python, os.path.join(host_dir, 'aprinter_encode.py'), '--input', corpus, '--output', packed]),
+    ]
+    try:
+        import numpy
+        commands.append(('encode_file_numpy', [python, os.path.join(host_dir, 'aprinter_encode.py'), '--input', corpus, '--output', packed, '--numpy']))
+    except ImportError:
+        pass
+    detool = [python, os.path.join(host_dir, 'DeTool.py'), '--input', corpus, '--output', os.path.join(work_dir, 'out.gcode'), '--tool-travel-speed', '120']
+    for tool in range(num_tools):
+        detool += ['--physical', 'EUVW'[tool % 4], str(-10.0 * tool), '0', '0', '--tool', str(tool), str(tool)]
+    commands.append(('DeTool', detool))
+    return commands
+
+def _run_child(command):
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=devnull)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('Benchmark command failed: {}'.format(' '.join(command)))
+    return elapsed, rusage.ru_maxrss
+
+def bench_suite(args):
+    work_dir = tempfile.mkdtemp(prefix='aprinter_bench')
+    try:
+        corpora = list(args.corpus or [])
+        if args.lines > 0:
+            synthetic = os.path.join(work_dir, 'synthetic.gcode')
+            with open(synthetic, 'wb') as output_file:
+                generate_corpus(output_file, args.lines, parse_mix(args.mix), args.tools, args.seed)
+            corpora.append(synthetic)
+        results = []
+        for corpus in corpora:
+            with open(corpus, 'rb') as input_file:
+                num_lines = sum(1 for _ in input_file)
+            num_bytes = os.path.getsize(corpus)
+            for (name, command) in _suite_commands(corpus, work_dir, args.tools):
+                runs = [_run_child(command) for _ in range(args.repeat)]
+                elapsed = min(run[0] for run in runs)
+                peak_rss_kb = max(run[1] for run in runs)
+                result = {
+                    'corpus': os.path.basename(corpus),
+                    'tool': name,
+                    'lines': num_lines,
+                    'bytes': num_bytes,
+                    'seconds': elapsed,
+                    'lines_per_s': num_lines / elapsed,
+                    'mb_per_s': num_bytes / elapsed / 1e6,
+                    'peak_rss_kb': peak_rss_kb,
+                }
+                results.append(result)
+                print('{:<20} {:<18} {:>10.0f} lines/s {:>8.2f} MB/s {:>8} KiB'.format(result['corpus'], name, result['lines_per_s'], result['mb_per_s'], peak_rss_kb))
+    finally:
+        for file_name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, file_name))
+        os.rmdir(work_dir)
+    if args.output:
+        report = {
+            'revision': _revision(),
+            'python': sys.version.split()[0],
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'mix': args.mix,
+            'results': results,
+        }
+        with open(args.output, 'wb') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+def bench_compare(args):
+    with open(args.old, 'rb') as old_file:
+        old = json.load(old_file)
+    with open(args.new, 'rb') as new_file:
+        new = json.load(new_file)
+    print('old: {}, new: {}'.format(old['revision'], new['revision']))
+    old_results = dict(((result['corpus'], result['tool']), result) for result in old['results'])
+    for result in new['results']:
+        key = (result['corpus'], result['tool'])
+        if key not in old_results:
+            continue
+        old_result = old_results[key]
+        print('{:<20} {:<18} {:>6.2f}x speed {:>6.2f}x RSS'.format(key[0], key[1], result['lines_per_s'] / old_result['lines_per_s'], float(result['peak_rss_kb']) / old_result['peak_rss_kb']))
+
+def bench_generate(args):
+    with open(args.output, 'wb') as output_file:
+        generate_corpus(output_file, args.lines, parse_mix(args.mix), args.tools, args.seed)
+
+def bench_encode_lines(args):
+    # Child of the suite: encode_line() on every line, without file output.
+    encode_line = aprinter_encode.encode_line
+    with open(args.input, 'rb') as input_file:
+        for line in input_file:
+            encode_line(line)
+
+def bench_replace(args):
+    # DeTool's placeholder substitution, the old loop against the compiled
+    # matcher, for the placeholders of the given number of tools.
+    import DeTool
+    match = ['{T%sAxis}' % (i) for i in range(args.tools)] + ['?T%sAxis?' % (i) for i in range(args.tools)]
+    replace = ['E'] * len(match)
+    with open(args.input, 'rb') as input_file:
+        lines = [line.strip() for line in input_file]
+    multi_replace = DeTool.MultiReplace(match, replace)
+    for line in lines:
+        if DeTool.replace_multi(line, match, replace) != multi_replace(line):
+            raise RuntimeError('Substitution mismatch on line: {}'.format(line))
+    def run_loop():
+        for line in lines:
+            DeTool.replace_multi(line, match, replace)
+    def run_compiled():
+        for line in lines:
+            multi_replace(line)
+    loop_time, _ = _best_time(run_loop, args.repeat)
+    compiled_time, _ = _best_time(run_compiled, args.repeat)
+    print('replace_multi: {:.3f} s ({:.0f} lines/s)'.format(loop_time, len(lines) / loop_time))
+    print('MultiReplace:  {:.3f} s ({:.0f} lines/s)'.format(compiled_time, len(lines) / compiled_time))
+    print('Speedup: {:.1f}x'.format(loop_time / compiled_time))
+
+def bench_tokenize(args):
+    # Words of each line of a mapped file: slicing out the line and
+    # splitting it, as the encoder does, against finding the words by
+    # offset in the mapping and slicing out only them.
+    def split_words(line):
+        # As encode_line_into() does.
+        comment_index = line.find(';')
+        if comment_index >= 0:
+            line = line[:comment_index]
+        return line.split()
+    with open(args.input, 'rb') as input_file:
+        data = aprinter_encode.map_input(input_file)
+        if data is None:
+            raise RuntimeError('Cannot map the input: {}'.format(args.input))
+        line_count = 0
+        for (split_line, offset_line) in zip((split_words(line) for line in aprinter_encode.iter_mapped_lines(data)), _offset_words(data)):
+            if split_line != offset_line:
+                raise RuntimeError('Tokenization mismatch: {} against {}'.format(split_line, offset_line))
+            line_count += 1
+        def run_split():
+            for words in (split_words(line) for line in aprinter_encode.iter_mapped_lines(data)):
+                pass
+        def run_offset():
+            for words in _offset_words(data):
+                pass
+        split_time, _ = _best_time(run_split, args.repeat)
+        offset_time, _ = _best_time(run_offset, args.repeat)
+    print('slice and split: {:.3f} s ({:.0f} lines/s)'.format(split_time, line_count / split_time))
+    print('by offset:       {:.3f} s ({:.0f} lines/s)'.format(offset_time, line_count / offset_time))
+    print('Speedup: {:.2f}x'.format(split_time / offset_time))
+
+def _offset_words(data):
+    # Words separated by spaces, with CR line ends, which is what slicers
+    # write; other whitespace is not handled.
+    find = data.find
+    start = 0
+    end = len(data)
+    while start < end:
+        line_end = find('\n', start, end)
+        if line_end < 0:
+            line_end = end
+        data_end = find(';', start, line_end)
+        if data_end < 0:
+            data_end = line_end
+            if data_end > start and data[data_end - 1] == '\r':
+                data_end -= 1
+        words = []
+        pos = start
+        while pos < data_end:
+            word_end = find(' ', pos, data_end)
+            if word_end < 0:
+                word_end = data_end
+            if word_end > pos:
+                words.append(data[pos:word_end])
+            pos = word_end + 1
+        yield words
+        start = line_end + 1
+
+def _revision():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def bench_cache(args):
+    with open(args.input, 'rb') as input_file:
+        data = input_file.read()
+    line_count = data.count('\n')
+    results = []
+    for cache_size in (0, args.cache_size):
+        def run():
+            cache = aprinter_encode.PacketCache(cache_size) if cache_size > 0 else None
+            aprinter_encode.encode_stream(io.BytesIO(data), io.BytesIO(), cache=cache)
+            return cache
+        elapsed, cache = _best_time(run, args.repeat)
+        results.append(elapsed)
+        if cache is None:
+            print('no cache:      {:10.0f} lines/s'.format(line_count / elapsed))
+        else:
+            hit_rate = 100.0 * cache.hits / max(1, cache.hits + cache.misses)
+            print('cache {:<7} {:10.0f} lines/s, {:.1f}% hits'.format(cache_size, line_count / elapsed, hit_rate))
+    print('speedup:       {:10.2f}x'.format(results[0] / results[1]))
+
+def bench_delta(args):
+    with open(args.input, 'rb') as input_file:
+        data = input_file.read()
+    line_count = data.count('\n')
+    print('{:<8} {:>12} {:>10} {:>14} {:>12}'.format('mode', 'bytes', 'moves', 'bytes/move', 'lines/s'))
+    for delta in (False, True):
+        def run():
+            output_file = io.BytesIO()
+            aprinter_encode.encode_stream(io.BytesIO(data), output_file, delta=delta)
+            return output_file.getvalue()
+        elapsed, packed = _best_time(run, args.repeat)
+        moves = 0
+        move_bytes = 0
+        for packet in aprinter_decode.iter_packets(packed):
+            if packet.cmd_letter == 'G' and packet.cmd_number in (0, 1):
+                moves += 1
+                move_bytes += packet.size
+        print('{:<8} {:>12} {:>10} {:>14.2f} {:>12.0f}'.format('delta' if delta else 'float', len(packed), moves, float(move_bytes) / max(1, moves), line_count / elapsed))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks for the APrinter host tools.')
+    subparsers = parser.add_subparsers()
+    
+    cache_parser = subparsers.add_parser('cache', help='Compare packing with and without the repeated line cache.')
+    cache_parser.add_argument('--input', required=True, help='G-code file, e.g. real slicer output.')
+    cache_parser.add_argument('--cache-size', type=int, default=aprinter_encode.DefaultCacheSize)
+    cache_parser.add_argument('--repeat', type=int, default=3)
+    cache_parser.set_defaults(func=bench_cache)
+    
+    delta_parser = subparsers.add_parser('delta', help='Compare packed size and speed with and without delta encoding.')
+    delta_parser.add_argument('--input', required=True, help='G-code file.')
+    delta_parser.add_argument('--repeat', type=int, default=3)
+    delta_parser.set_defaults(func=bench_delta)
+    
+    suite_parser = subparsers.add_parser('suite', help='Time the host tools on synthetic and given corpora.')
+    suite_parser.add_argument('--corpus', action='append', help='Real-world g-code file to include (repeatable).')
+    suite_parser.add_argument('--lines', type=int, default=200000, help='Size of the synthetic corpus (0 for none).')
+    suite_parser.add_argument('--mix', default=DefaultMix, help='Weights of command kinds in the synthetic corpus.')
+    suite_parser.add_argument('--tools', type=int, default=2, help='Number of tools used in the synthetic corpus.')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--repeat', type=int, default=3)
+    suite_parser.add_argument('--output', help='Write the results to this JSON file.')
+    suite_parser.set_defaults(func=bench_suite)
+    
+    compare_parser = subparsers.add_parser('compare', help='Compare two JSON results of the suite.')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.set_defaults(func=bench_compare)
+    
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic corpus.')
+    generate_parser.add_argument('--output', required=True)
+    generate_parser.add_argument('--lines', type=int, default=200000)
+    generate_parser.add_argument('--mix', default=DefaultMix)
+    generate_parser.add_argument('--tools', type=int, default=2)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.set_defaults(func=bench_generate)
+    
+    replace_parser = subparsers.add_parser('replace', help='Compare DeTool placeholder substitution methods.')
+    replace_parser.add_argument('--input', required=True)
+    replace_parser.add_argument('--tools', type=int, default=3, help='Number of tools whose placeholders are substituted.')
+    replace_parser.add_argument('--repeat', type=int, default=3)
+    replace_parser.set_defaults(func=bench_replace)
+    
+    tokenize_parser = subparsers.add_parser('tokenize', help='Compare splitting lines of a mapped file with finding the words by offset.')
+    tokenize_parser.add_argument('--input', required=True)
+    tokenize_parser.add_argument('--repeat', type=int, default=3)
+    tokenize_parser.set_defaults(func=bench_tokenize)
+    
+    encode_lines_parser = subparsers.add_parser('encode-lines', help=argparse.SUPPRESS)
+    encode_lines_parser.add_argument('--input', required=True)
+    encode_lines_parser.set_defaults(func=bench_encode_lines)
+    
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python2.7
+
+from __future__ import print_function
+from __future__ import with_statement
+import os
+import sys
+import struct
+import mmap
+import array
+import bisect
+
+class PacketFormatError(Exception):
+    pass
+
+DecodeErrors = PacketFormatError
+
+DeltaUnitsPerValue = 100000
+IndexMagic = 'APIX'
+IndexVersion = 1
+
+class FixedValue(float):
+    # A parameter value decoded from a delta, which is exact in units of
+    # 1/DeltaUnitsPerValue and is printed as such.
+    pass
+
+class DeltaState(object):
+    # Previous parameter values, in fixed-point units, for decoding deltas.
+    def __init__(self):
+        self.previous = {}
+
+class Packet(object):
+    # A view of one packet in the underlying buffer. Parameters are only
+    # decoded when asked for.
+
+    __slots__ = ('data', 'offset', 'size', 'cmd_letter', 'cmd_number', 'index_offset', 'num_params')
+
+    def __init__(self, data, offset, size, cmd_letter, cmd_number, index_offset, num_params):
+        self.data = data
+        self.offset = offset
+        self.size = size
+        self.cmd_letter = cmd_letter
+        self.cmd_number = cmd_number
+        self.index_offset = index_offset
+        self.num_params = num_params
+
+    def is_eof(self):
+        return self.cmd_number is None
+
+    def command(self):
+        if self.is_eof():
+            return 'EOF'
+        return '{}{}'.format(self.cmd_letter, self.cmd_number)
+
+    def params(self, delta_state=None):
+        # Delta encoded parameters need the DeltaState of the preceding
+        # packets, which is advanced by this call.
+        data = self.data
+        index = _IndexStructs[self.num_params].unpack_from(data, self.index_offset)
+        payload_pos = self.index_offset + self.num_params
+        is_move = self.cmd_letter == 'G' and self.cmd_number in (0, 1)
+        tracked = delta_state is not None and (is_move or (self.cmd_letter == 'G' and self.cmd_number == 92))
+        params = []
+        for index_elem in index:
+            type_code = index_elem >> 5
+            letter_code = index_elem & 0x1F
+            param_letter = chr(ord('A') + letter_code)
+            payload_struct = _PayloadStructs[type_code]
+            if payload_struct is None:
+                params.append((param_letter, None))
+                continue
+            value = payload_struct.unpack_from(data, payload_pos)[0]
+            payload_pos += payload_struct.size
+            if type_code >= 6:
+                if not is_move:
+                    raise PacketFormatError('offset {}: delta parameter outside of G0/G1'.format(self.offset))
+                if delta_state is None or letter_code not in delta_state.previous:
+                    raise PacketFormatError('offset {}: delta parameter without previous value'.format(self.offset))
+                units = delta_state.previous[letter_code] + value * (DeltaCoarseUnits if type_code == 6 else 1)
+                delta_state.previous[letter_code] = units
+                value = FixedValue(float(units) / DeltaUnitsPerValue)
+            elif tracked:
+                if value != value or value in (_Infinity, -_Infinity):
+                    delta_state.previous.pop(letter_code, None)
+                elif type_code == 1 or type_code == 2:
+                    delta_state.previous[letter_code] = int(round(value * DeltaUnitsPerValue))
+                else:
+                    delta_state.previous[letter_code] = value * DeltaUnitsPerValue
+            params.append((param_letter, value))
+        return params
+
+    def raw(self):
+        return self.data[self.offset:self.offset + self.size]
+
+    def to_line(self, delta_state=None):
+        return format_command(self.command(), self.params(delta_state))
+
+def iter_packets(data, offset=0, end=None):
+    if end is None:
+        end = len(data)
+    while offset < end:
+        header = _Byte.unpack_from(data, offset)[0]
+        type_code = header >> 4
+        num_params = header & 0xF
+        if type_code in _SmallCommands:
+            cmd_letter, cmd_number = _SmallCommands[type_code]
+            index_offset = offset + 1
+        elif type_code == 15:
+            if offset + 3 > end:
+                raise PacketFormatError('offset {}: truncated packet header'.format(offset))
+            header_large = _Word.unpack_from(data, offset + 1)[0]
+            letter_code = header_large >> 11
+            if letter_code > 25:
+                raise PacketFormatError('offset {}: invalid command letter'.format(offset))
+            cmd_letter = chr(ord('A') + letter_code)
+            cmd_number = header_large & 0x7FF
+            index_offset = offset + 3
+        elif type_code == 14:
+            if num_params != 0:
+                raise PacketFormatError('offset {}: EOF packet with parameters'.format(offset))
+            yield Packet(data, offset, 1, 'E', None, offset + 1, 0)
+            offset += 1
+            continue
+        else:
+            raise PacketFormatError('offset {}: reserved operation type {}'.format(offset, type_code))
+        if num_params > 14:
+            raise PacketFormatError('offset {}: reserved index size'.format(offset))
+        if index_offset + num_params > end:
+            raise PacketFormatError('offset {}: truncated packet index'.format(offset))
+        payload_size = 0
+        for index_elem in _IndexStructs[num_params].unpack_from(data, index_offset):
+            elem_size = _IndexPayloadSizes[index_elem]
+            if elem_size is None:
+                raise PacketFormatError('offset {}: invalid parameter index element'.format(offset))
+            payload_size += elem_size
+        size = index_offset + num_params + payload_size - offset
+        if offset + size > end:
+            raise PacketFormatError('offset {}: truncated packet payload'.format(offset))
+        yield Packet(data, offset, size, cmd_letter, cmd_number, index_offset, num_params)
+        offset += size
+
+def iter_commands(data, offset=0, end=None):
+    delta_state = DeltaState()
+    for packet in iter_packets(data, offset, end):
+        yield (packet.command(), packet.params(delta_state))
+
+def format_command(command, params):
+    parts = [command]
+    for (param_letter, value) in params:
+        if value is None:
+            parts.append(param_letter)
+        elif isinstance(value, FixedValue):
+            parts.append(param_letter + _format_fixed(value))
+        elif isinstance(value, float):
+            parts.append(param_letter + _format_real(value))
+        else:
+            parts.append('{}{}'.format(param_letter, value))
+    return ' '.join(parts)
+
+def decode_buffer(data, output_file, offset=0):
+    # The final EOF packet terminates the file and has no line of its own,
+    # so that encoding the output reproduces the input exactly. Decoding may
+    # start at an index checkpoint, where no delta state is needed.
+    end = len(data)
+    if end == 0 or _Byte.unpack_from(data, end - 1)[0] != 0xE0:
+        raise PacketFormatError('missing final EOF packet')
+    count = 0
+    delta_state = DeltaState()
+    for packet in iter_packets(data, offset, end - 1):
+        output_file.write(packet.to_line(delta_state) + '\n')
+        count += 1
+    return count
+
+class PacketIndex(object):
+    # The sidecar index written by aprinter_encode.py --index, see
+    # encoding.txt. Seeking is a binary search over the checkpoints.
+    def __init__(self, interval, lines, offsets, z, layer_z, layer_checkpoints):
+        self.interval = interval
+        self.lines = lines
+        self.offsets = offsets
+        self.z = z
+        self.layer_z = layer_z
+        self.layer_checkpoints = layer_checkpoints
+    
+    def checkpoint(self, i):
+        # Returns (source line, packet offset, Z before the packet).
+        return (self.lines[i], self.offsets[i], self.z[i])
+    
+    def seek_line(self, line):
+        # The last checkpoint at or before the given source line.
+        i = bisect.bisect_right(self.lines, line) - 1
+        if i < 0:
+            raise KeyError(line)
+        return self.checkpoint(i)
+    
+    def seek_layer(self, z):
+        # The checkpoint which starts the lowest layer at or above Z.
+        i = bisect.bisect_left(self.layer_z, _Float.unpack(_Float.pack(z))[0])
+        if i == len(self.layer_z):
+            raise KeyError(z)
+        return self.checkpoint(self.layer_checkpoints[i])
+
+def read_index(index_file):
+    header = index_file.read(20)
+    if len(header) != 20 or header[:4] != IndexMagic:
+        raise PacketFormatError('not a packed g-code index')
+    version, interval, num_checkpoints, num_layers = struct.unpack('<IIII', header[4:])
+    if version != IndexVersion:
+        raise PacketFormatError('unsupported index version {}'.format(version))
+    arrays = []
+    for (typecode, count) in (('I', num_checkpoints), ('I', num_checkpoints), ('f', num_checkpoints), ('f', num_layers), ('I', num_layers)):
+        values = array.array(typecode)
+        try:
+            values.fromfile(index_file, count)
+        except EOFError:
+            raise PacketFormatError('truncated index')
+        if sys.byteorder != 'little':
+            values.byteswap()
+        arrays.append(values)
+    return PacketIndex(interval, *arrays)
+
+def load_index(index_file_name):
+    with open(index_file_name, "rb") as index_file:
+        return read_index(index_file)
+
+DecodeFileErrors = (IOError, PacketFormatError)
+
+def map_file(input_file):
+    if _file_size(input_file) == 0:
+        return ''
+    return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def decode_file(input_file_name, output_file_name, offset=0):
+    with open(input_file_name, "rb") as input_file:
+        data = map_file(input_file)
+        with open(output_file_name, "wb") as output_file:
+            return decode_buffer(data, output_file, offset)
+
+_SmallCommands = {
+    1 : ('G', 0),
+    2 : ('G', 1),
+    3 : ('G', 92),
+}
+
+_Byte = struct.Struct('<B')
+_Word = struct.Struct('>H')
+_Float = struct.Struct('<f')
+_IndexStructs = [struct.Struct('<{}B'.format(i)) for i in range(15)]
+
+_Int16 = struct.Struct('<h')
+_PayloadStructs = [None, _Float, struct.Struct('<d'), struct.Struct('<I'), struct.Struct('<Q'), None, _Int16, _Int16]
+_PayloadSizes = [None, 4, 8, 4, 8, 0, 2, 2]
+DeltaCoarseUnits = 100
+
+_Infinity = float('inf')
+
+_IndexPayloadSizes = [(_PayloadSizes[i >> 5] if (i & 0x1F) <= 25 else None) for i in range(256)]
+
+def _format_real(value):
+    # Use the shortest text which reads back as the same float, and make
+    # sure the encoder will not mistake it for an integer.
+    if value != value:
+        return 'nan'
+    for precision in (6, 7, 8, 9, 17):
+        text = '%.*g' % (precision, value)
+        try:
+            if _Float.unpack(_Float.pack(float(text)))[0] == value:
+                break
+        except OverflowError:
+            pass
+    if '.' not in text and 'e' not in text and 'n' not in text:
+        text += '.0'
+    return text
+
+def _format_fixed(value):
+    text = ('%.5f' % value).rstrip('0')
+    if text.endswith('.'):
+        text += '0'
+    return text
+
+def _file_size(input_file):
+    return os.fstat(input_file.fileno()).st_size
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Packed g-code decoder for APrinter firmware.')
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', help='Write the decoded g-code to this file.')
+    parser.add_argument('--index', help='Sidecar index written by aprinter_encode.py --index.')
+    seek_group = parser.add_mutually_exclusive_group()
+    seek_group.add_argument('--line', type=int, help='Start at the last checkpoint before this source line (needs --index).')
+    seek_group.add_argument('--layer', type=float, help='Start at the layer at or above this Z (needs --index).')
+    args = parser.parse_args()
+    offset = 0
+    if args.line is not None or args.layer is not None:
+        if args.index is None:
+            parser.error('--line and --layer need --index')
+        index = load_index(args.index)
+        try:
+            if args.line is not None:
+                line, offset, z = index.seek_line(args.line)
+            else:
+                line, offset, z = index.seek_layer(args.layer)
+        except KeyError:
+            parser.error('no checkpoint found')
+        print('Checkpoint: line {}, offset {}, Z {}'.format(line, offset, _format_real(z)))
+    if args.output is not None:
+        count = decode_file(args.input, args.output, offset)
+    else:
+        with open(args.input, "rb") as input_file:
+            data = map_file(input_file)
+            counts = {}
+            count = 0
+            for packet in iter_packets(data, offset):
+                command = packet.command()
+                counts[command] = counts.get(command, 0) + 1
+                count += 1
+        for command in sorted(counts):
+            print('{:<8} {}'.format(command, counts[command]))
+    print('{} packets'.format(count))
+
+if __name__ == '__main__':
+    main()
@@ -2,96 +2,819 @@
 
 from __future__ import print_function
 from __future__ import with_statement
+import os
+import sys
+import io
+import time
+import select
+import array
+import stat
+import mmap
 import struct
+import warnings
 
 class GcodeSyntaxError(Exception):
     pass
 
 EncodeLineErrors = GcodeSyntaxError
 
+# Header (up to 3 bytes), one index byte and up to 8 payload bytes per parameter.
+MaxPacketSize = 3 + 14 * (1 + 8)
+
+InputBlockSize = 2**20
+OutputBufferSize = 2**20
+ParallelChunkSize = 2**23
+PoolWaitTimeout = 60.0
+DefaultCacheSize = 4096
+DeltaUnitsPerValue = 100000
+DeltaCoarseUnits = 100
+BulkRunSize = 4096
+BulkMinRunSize = 64
+DefaultMaxLatency = 0.2
+DefaultIndexInterval = 1000
+IndexMagic = 'APIX'
+IndexVersion = 1
+
 def encode_line(line):
+    buf = bytearray(MaxPacketSize)
+    length = encode_line_into(line, buf, 0)
+    return str(buf[:length])
+
+def encode_line_into(line, buf, pos):
     comment_index = line.find(';')
     if comment_index >= 0:
         line = line[:comment_index]
-    line = line.strip()
-    if len(line) == 0:
-        return ''
     parts = line.split()
-    cmd_letter = parts[0][0]
-    if cmd_letter == 'E':
-        return chr(0xE0)
-    if not _letter_ok(cmd_letter):
-        raise GcodeSyntaxError('invalid command letter')
-    try:
-        cmd_number = int(parts[0][1:])
-    except ValueError:
-        raise GcodeSyntaxError('invalid command number')
-    if not (cmd_number >= 0 and cmd_number < 2048):
-        raise GcodeSyntaxError('invalid command number')
-    packet_index = ''
-    packet_payload = ''
+    if len(parts) == 0:
+        return pos
+    if parts[0][0] == 'E':
+        buf[pos] = 0xE0
+        return pos + 1
+    header = _CommandHeaders.get(parts[0])
+    if header is None:
+        header = _make_command_header(parts[0])
     num_params = len(parts) - 1
     if num_params > 14:
         raise GcodeSyntaxError('too many parameters')
+    command_type_code, header_large = header
+    buf[pos] = (command_type_code << 4) + num_params
+    if header_large is None:
+        index_pos = pos + 1
+    else:
+        buf[pos + 1:pos + 3] = header_large
+        index_pos = pos + 3
+    payload_pos = index_pos + num_params
+    letter_codes = _LetterCodes
     for part in parts[1:]:
-        param_letter = part[0]
-        if not _letter_ok(param_letter):
+        letter_code = letter_codes.get(part[0])
+        if letter_code is None:
             raise GcodeSyntaxError('invalid parameter letter')
         param_value = part[1:]
-        if param_value == '':
-            encode_as = 'void'
+        if param_value.isdigit() or (param_value[1:].isdigit() and param_value[0] in '+-'):
+            # This is what int() accepts; negative or huge values fall back to real.
+            integer_value = int(param_value)
+            if integer_value < 0 or integer_value >= 2**64:
+                integer_value = None
+        elif param_value == '':
+            buf[index_pos] = (5 << 5) + letter_code
+            index_pos += 1
+            continue
         else:
-            encode_as = 'integer'
+            integer_value = None
+        if integer_value is None:
             try:
-                integer_value = int(param_value)
-                if not (integer_value >= 0 and integer_value < 2**64):
-                    raise ValueError()
+                real_value = float(param_value)
             except ValueError:
-                encode_as = 'real'
-                try:
-                    real_value = float(param_value)
-                except ValueError:
-                    raise GcodeSyntaxError('invalid command argument')
-        if encode_as == 'void':
-            type_code = 5
-            param_payload = ''
-        elif encode_as == 'integer':
-            if integer_value < 2**32:
-                type_code = 3
-                param_payload = struct.pack('<I', integer_value)
-            else:
-                type_code = 4
-                param_payload = struct.pack('<Q', integer_value)
-        elif encode_as == 'real':
-            type_code = 1
-            param_payload = struct.pack('<f', real_value)
-        packet_index += chr((type_code << 5) + (ord(param_letter) - ord('A')))
-        packet_payload += param_payload
-    if (cmd_letter, cmd_number) in _SmallCommands:
-        command_type_code = _SmallCommands[(cmd_letter, cmd_number)]
-        packet_header_large = ''
+                raise GcodeSyntaxError('invalid command argument')
+            buf[index_pos] = (1 << 5) + letter_code
+            _Float.pack_into(buf, payload_pos, real_value)
+            payload_pos += 4
+        elif integer_value < 2**32:
+            buf[index_pos] = (3 << 5) + letter_code
+            _Uint32.pack_into(buf, payload_pos, integer_value)
+            payload_pos += 4
+        else:
+            buf[index_pos] = (4 << 5) + letter_code
+            _Uint64.pack_into(buf, payload_pos, integer_value)
+            payload_pos += 8
+        index_pos += 1
+    return payload_pos
+
+def encode_command_into(cmd, params, buf, pos):
+    # Encodes a command given as numbers, such as ('G1', [('X', 10.0)]),
+    # the way encode_line_into() encodes the same command as text, but
+    # without formatting and parsing the numbers. Parameters are floats
+    # (float), integers (uint32/uint64, or float if out of range) or None
+    # (void).
+    header = _CommandHeaders.get(cmd)
+    if header is None:
+        header = _make_command_header(cmd)
+    num_params = len(params)
+    if num_params > 14:
+        raise GcodeSyntaxError('too many parameters')
+    command_type_code, header_large = header
+    buf[pos] = (command_type_code << 4) + num_params
+    if header_large is None:
+        index_pos = pos + 1
     else:
-        command_type_code = 15
-        packet_header_large = struct.pack('BB', ((ord(cmd_letter) - ord('A')) << 3) + (cmd_number >> 8), (cmd_number & 0xFF))
-    packet_header = struct.pack('B', (command_type_code << 4) + num_params) + packet_header_large
-    packet = packet_header + packet_index + packet_payload
-    return packet
+        buf[pos + 1:pos + 3] = header_large
+        index_pos = pos + 3
+    payload_pos = index_pos + num_params
+    letter_codes = _LetterCodes
+    for (letter, value) in params:
+        letter_code = letter_codes.get(letter)
+        if letter_code is None:
+            raise GcodeSyntaxError('invalid parameter letter')
+        if value is None:
+            buf[index_pos] = (5 << 5) + letter_code
+        elif isinstance(value, float) or value < 0 or value >= 2**64:
+            buf[index_pos] = (1 << 5) + letter_code
+            _Float.pack_into(buf, payload_pos, value)
+            payload_pos += 4
+        elif value < 2**32:
+            buf[index_pos] = (3 << 5) + letter_code
+            _Uint32.pack_into(buf, payload_pos, value)
+            payload_pos += 4
+        else:
+            buf[index_pos] = (4 << 5) + letter_code
+            _Uint64.pack_into(buf, payload_pos, value)
+            payload_pos += 8
+        index_pos += 1
+    return payload_pos
+
+class PacketCache(object):
+    # Memo of encoded packets keyed on the line as read, so that a repeated
+    # line costs a single dict lookup. Entries live in two generations; when
+    # the recent one fills up the old one is dropped, which approximates LRU
+    # order. A line is first only remembered as seen and its packet is
+    # stored when it repeats, which keeps unique lines (most moves) cheap.
+    def __init__(self, size=DefaultCacheSize):
+        assert size >= 2
+        self.generation_size = size // 2
+        self.recent = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def encode_line_into(self, line, buf, pos):
+        recent = self.recent
+        packet = recent.get(line)
+        if packet is None:
+            packet = self.old.get(line)
+            if packet is None:
+                self.misses += 1
+                end = encode_line_into(line, buf, pos)
+                if line in recent:
+                    recent[line] = str(buf[pos:end])
+                else:
+                    if len(recent) >= self.generation_size:
+                        self.old = recent
+                        self.recent = recent = {}
+                    recent[line] = None
+                return end
+            if len(recent) >= self.generation_size:
+                self.old = recent
+                self.recent = recent = {}
+            recent[line] = packet
+        self.hits += 1
+        end = pos + len(packet)
+        buf[pos:end] = packet
+        return end
+
+class DeltaEncoder(object):
+    # Rewrites parameters of G0/G1 packets as 16-bit fixed-point deltas from
+    # the previous value of the same letter where the difference fits (see
+    # encoding.txt). Works on the packets of another encoder, so it tracks
+    # exactly what a decoder will see.
+    def __init__(self, encode_into=encode_line_into):
+        self.base_encode_into = encode_into
+        self.previous = {}
+    
+    def reset(self):
+        self.previous.clear()
+    
+    def encode_line_into(self, line, buf, pos):
+        return self.finish_packet(buf, pos, self.base_encode_into(line, buf, pos))
+    
+    def finish_packet(self, buf, pos, end):
+        # Rewrites the packet at buf[pos:end] and returns its new end.
+        if end == pos:
+            return end
+        command_type_code = buf[pos] >> 4
+        if command_type_code == 1 or command_type_code == 2:
+            return self._update_packet(buf, pos, True)
+        if command_type_code == 3:
+            return self._update_packet(buf, pos, False)
+        return end
+    
+    def _update_packet(self, buf, pos, use_deltas):
+        previous = self.previous
+        num_params = buf[pos] & 0xF
+        index_pos = pos + 1
+        read_pos = write_pos = index_pos + num_params
+        for index_pos in range(index_pos, index_pos + num_params):
+            index_elem = buf[index_pos]
+            type_code = index_elem >> 5
+            letter_code = index_elem & 0x1F
+            if type_code == 5:
+                continue
+            payload_struct = _PayloadStructs[type_code]
+            value = payload_struct.unpack_from(buf, read_pos)[0]
+            if value != value or value in (_Infinity, -_Infinity):
+                previous.pop(letter_code, None)
+                target = None
+            elif type_code == 1:
+                target = int(round(value * DeltaUnitsPerValue))
+            else:
+                target = value * DeltaUnitsPerValue
+            delta = None
+            if use_deltas and target is not None and letter_code != _FeedrateLetterCode and letter_code in previous:
+                delta = target - previous[letter_code]
+                if delta % DeltaCoarseUnits == 0 and -2**15 <= delta // DeltaCoarseUnits < 2**15:
+                    buf[index_pos] = (6 << 5) + letter_code
+                    _Int16.pack_into(buf, write_pos, delta // DeltaCoarseUnits)
+                elif -2**15 <= delta < 2**15:
+                    buf[index_pos] = (7 << 5) + letter_code
+                    _Int16.pack_into(buf, write_pos, delta)
+                else:
+                    delta = None
+            if delta is None:
+                buf[write_pos:write_pos + payload_struct.size] = buf[read_pos:read_pos + payload_struct.size]
+                write_pos += payload_struct.size
+            else:
+                write_pos += 2
+            read_pos += payload_struct.size
+            if target is not None:
+                previous[letter_code] = target
+        return write_pos
+
+class IndexBuilder(object):
+    # Records checkpoints (source line, output offset, Z before the packet)
+    # for the sidecar index described in encoding.txt: at the first packet,
+    # every interval packets and at every packet which changes Z. Layers are
+    # the checkpoints where Z was raised before printing at a new height.
+    # Delta state is reset at checkpoints, so that decoding can start there.
+    def __init__(self, interval=DefaultIndexInterval):
+        assert interval >= 1
+        self.interval = interval
+        self.lines = array.array('I')
+        self.offsets = array.array('I')
+        self.z = array.array('f')
+        self.layer_z = array.array('f')
+        self.layer_checkpoints = array.array('I')
+        self.writer = None
+        self.delta = None
+    
+    def start(self, writer, encode_into):
+        self.writer = writer
+        self.base_encode_into = encode_into
+        self.line_number = 0
+        self.packets_since = self.interval
+        self.current_z = _NaN
+        self.relative = False
+        self.z_checkpoint = 0
+    
+    def encode_line_into(self, line, buf, pos):
+        self.line_number += 1
+        end = self.base_encode_into(line, buf, pos)
+        if end == pos:
+            return end
+        checkpoint = self.packets_since >= self.interval
+        z_before = self.current_z
+        z_changed = False
+        printing = False
+        command_type_code = buf[pos] >> 4
+        if command_type_code <= 3:
+            z_param, printing = self._scan_packet(buf, pos)
+            if z_param is not None:
+                if command_type_code == 3 or not self.relative:
+                    self.current_z = z_param
+                else:
+                    self.current_z += z_param
+                z_changed = not (self.current_z == z_before)
+            printing = printing and command_type_code == 2
+        elif command_type_code == 15:
+            header_large = buf[pos + 1:pos + 3]
+            if header_large == _HeaderG90:
+                self.relative = False
+            elif header_large == _HeaderG91:
+                self.relative = True
+            elif header_large == _HeaderG28:
+                num_params = buf[pos] & 0xF
+                if num_params == 0 or _ZLetterCode in [index_elem & 0x1F for index_elem in buf[pos + 3:pos + 3 + num_params]]:
+                    self.current_z = _NaN
+        if checkpoint or z_changed:
+            if z_changed:
+                self.z_checkpoint = len(self.lines)
+            self.lines.append(self.line_number)
+            self.offsets.append(self.writer.offset + pos)
+            self.z.append(z_before)
+            self.packets_since = 0
+            if self.delta is not None:
+                self.delta.reset()
+        self.packets_since += 1
+        if printing and self.current_z == self.current_z and (len(self.layer_z) == 0 or self.current_z > self.layer_z[-1]):
+            self.layer_z.append(self.current_z)
+            self.layer_checkpoints.append(self.z_checkpoint)
+        return end
+    
+    def _scan_packet(self, buf, pos):
+        # Returns the Z parameter of a G0/G1/G92 packet (or None) and whether
+        # it moves X or Y while extruding.
+        num_params = buf[pos] & 0xF
+        payload_pos = pos + 1 + num_params
+        z_param = None
+        letters = 0
+        for index_elem in buf[pos + 1:pos + 1 + num_params]:
+            type_code = index_elem >> 5
+            letter_code = index_elem & 0x1F
+            if letter_code == _ZLetterCode and type_code != 5:
+                z_param = float(_PayloadStructs[type_code].unpack_from(buf, payload_pos)[0])
+            letters |= 1 << letter_code
+            payload_pos += _PayloadSizes[type_code]
+        printing = (letters & _ExtrudeMask) != 0 and (letters & _PlaneMask) != 0
+        return (z_param, printing)
+    
+    def write(self, index_file):
+        index_file.write(IndexMagic + struct.pack('<IIII', IndexVersion, self.interval, len(self.lines), len(self.layer_z)))
+        for values in (self.lines, self.offsets, self.z, self.layer_z, self.layer_checkpoints):
+            if sys.byteorder != 'little':
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            values.tofile(index_file)
+
+class PacketWriter(object):
+    def __init__(self, output_file, buffer_size=OutputBufferSize, cache=None, delta=False, index=None):
+        assert buffer_size >= MaxPacketSize
+        self.output_file = output_file
+        self.buf = bytearray(buffer_size)
+        self.pos = 0
+        self.offset = 0
+        self.flush_limit = buffer_size - MaxPacketSize
+        self.encode_into = encode_line_into if cache is None else cache.encode_line_into
+        if index is not None:
+            index.start(self, self.encode_into)
+            self.encode_into = index.encode_line_into
+        self.delta = None
+        if delta:
+            self.delta = DeltaEncoder(self.encode_into)
+            self.encode_into = self.delta.encode_line_into
+        if index is not None:
+            index.delta = self.delta
+    
+    def write_line(self, line):
+        self.pos = self.encode_into(line, self.buf, self.pos)
+        if self.pos > self.flush_limit:
+            self.flush()
+    
+    def write_command(self, cmd, params):
+        # The cache and the index only see write_line().
+        end = encode_command_into(cmd, params, self.buf, self.pos)
+        if self.delta is not None:
+            end = self.delta.finish_packet(self.buf, self.pos, end)
+        self.pos = end
+        if self.pos > self.flush_limit:
+            self.flush()
+    
+    def write_packets(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buf):
+            self.flush()
+            if len(data) > self.flush_limit:
+                self.output_file.write(data)
+                self.offset += len(data)
+                return
+            end = len(data)
+        self.buf[self.pos:end] = data
+        self.pos = end
+        if self.pos > self.flush_limit:
+            self.flush()
+    
+    def write_eof(self):
+        self.buf[self.pos] = 0xE0
+        self.pos += 1
+        self.flush()
+    
+    def flush(self):
+        if self.pos > 0:
+            self.output_file.write(memoryview(self.buf)[:self.pos])
+            self.offset += self.pos
+            self.pos = 0
+
+def iter_lines(input_file, block_size=InputBlockSize):
+    rest = ''
+    while True:
+        block = input_file.read(block_size)
+        if len(block) == 0:
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if len(rest) > 0:
+        yield rest
+
+def iter_mapped_lines(data, start=0, end=None):
+    # Lines of a memory-mapped file, sliced directly out of the mapping
+    # without reading it into blocks first.
+    if end is None:
+        end = len(data)
+    find = data.find
+    while start < end:
+        line_end = find('\n', start, end)
+        if line_end < 0:
+            line_end = end
+        yield data[start:line_end]
+        start = line_end + 1
+
+def map_input(input_file):
+    # Returns a read-only mapping of a regular file, or None if the file
+    # cannot be mapped (pipes, in-memory files, empty files).
+    try:
+        fd = input_file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return None
+    return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
 
 EncodeFileErrors = (IOError, GcodeSyntaxError)
 
-def encode_file(input_file_name, output_file_name):
-    line_num = 0
-    with open(input_file_name, "r") as input_file:
-        with open(output_file_name, "w") as output_file:
-            for line in input_file:
-                line_num += 1
+def encode_stream(input_file, output_file, cache=None, bulk=False, delta=False, index=None):
+    if bulk and delta:
+        raise ValueError('The bulk encoder does not support delta encoding.')
+    if bulk and index is not None:
+        raise ValueError('The bulk encoder does not support indexing.')
+    writer = PacketWriter(output_file, cache=cache, delta=delta, index=index)
+    data = map_input(input_file)
+    lines = iter_lines(input_file) if data is None else iter_mapped_lines(data)
+    line_count, error = _encode_lines(lines, writer, bulk)
+    if error is not None:
+        writer.flush()
+        raise GcodeSyntaxError('line {}: {}'.format(line_count, error))
+    writer.write_eof()
+
+def encode_live(input_file, output_file, max_latency=DefaultMaxLatency, cache=None, delta=False, index=None):
+    # Encodes lines as they arrive on a pipe or FIFO, for printing a file
+    # which is still being written. Packets are flushed at most max_latency
+    # seconds after they are encoded, even if the input stalls. The EOF
+    # packet is only written when the input ends; on errors or interrupts
+    # the output stops after the last complete packet.
+    fd = input_file.fileno()
+    writer = PacketWriter(output_file, cache=cache, delta=delta, index=index)
+    rest = ''
+    line_count = 0
+    # The deadline is set while there is output not yet flushed to the
+    # file: in the writer, or written by it (when its buffer filled up)
+    # and still in the file's own buffer.
+    deadline = None
+    flushed = 0
+    try:
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            if len(select.select([fd], [], [], timeout)[0]) > 0:
+                block = os.read(fd, InputBlockSize)
+                if len(block) == 0:
+                    break
+                lines = (rest + block).split('\n')
+                rest = lines.pop()
+                count, error = _encode_lines(lines, writer)
+                line_count += count
+                if error is not None:
+                    _flush_live(writer, output_file)
+                    raise GcodeSyntaxError('line {}: {}'.format(line_count, error))
+                if deadline is None and writer.offset + writer.pos > flushed:
+                    deadline = time.time() + max_latency
+            if deadline is not None and time.time() >= deadline:
+                _flush_live(writer, output_file)
+                flushed = writer.offset
+                deadline = None
+        if len(rest) > 0:
+            count, error = _encode_lines([rest], writer)
+            if error is not None:
+                _flush_live(writer, output_file)
+                raise GcodeSyntaxError('line {}: {}'.format(line_count + count, error))
+    except KeyboardInterrupt:
+        _flush_live(writer, output_file)
+        raise
+    writer.write_eof()
+    output_file.flush()
+
+def _flush_live(writer, output_file):
+    writer.flush()
+    output_file.flush()
+
+def encode_file(input_file_name, output_file_name, jobs=1, cache_size=0, bulk=False, delta=False, index=None):
+    if jobs > 1 and index is not None:
+        raise ValueError('The parallel encoder does not support indexing.')
+    cache = PacketCache(cache_size) if cache_size > 0 else None
+    with open(input_file_name, "rb") as input_file:
+        with open(output_file_name, "wb") as output_file:
+            if jobs > 1:
+                encode_stream_parallel(input_file, output_file, jobs, cache=cache, bulk=bulk, delta=delta)
+            else:
+                encode_stream(input_file, output_file, cache=cache, bulk=bulk, delta=delta, index=index)
+    return cache
+
+def encode_stream_parallel(input_file, output_file, jobs, chunk_size=ParallelChunkSize, cache=None, bulk=False, delta=False):
+    # With delta encoding, each chunk starts without previous values, so
+    # the output differs from a sequential run but decodes the same.
+    import multiprocessing
+    cache_size = 0 if cache is None else 2 * cache.generation_size
+    chunks = ((input_file.name, start, end, cache_size, bulk, delta) for (start, end) in _split_at_lines(input_file, chunk_size))
+    pool = multiprocessing.Pool(jobs)
+    line_base = 0
+    results = pool_imap(pool, _encode_chunk, chunks, 2 * jobs, lambda result: result[2] is not None)
+    try:
+        for (data, line_count, error, cache_counts) in results:
+            output_file.write(data)
+            if cache is not None:
+                cache.hits += cache_counts[0]
+                cache.misses += cache_counts[1]
+            if error is not None:
+                raise GcodeSyntaxError('line {}: {}'.format(line_base + line_count, error))
+            line_base += line_count
+    finally:
+        results.close()
+    output_file.write(chr(0xE0))
+
+def pool_imap(pool, func, tasks, ahead, failed=None):
+    # pool.imap() for a generator of tasks, feeding at most ahead tasks more
+    # than have been consumed, and closing and joining the pool at the end.
+    # When a task raises, failed(result) is true or the consumer stops early,
+    # no further tasks are fed and the ones already fed are drained before
+    # the pool is joined; a task's exception is raised after that, as is
+    # one from the tasks generator. The pool is only terminated on
+    # KeyboardInterrupt, since terminating it while imap() is still feeding
+    # it can hang on Python 2.7. Results are waited for with a timeout,
+    # since a wait without one cannot be interrupted.
+    import threading
+    slots = threading.Semaphore(ahead)
+    stop = []
+    feed_failure = []
+    def feed():
+        # Python 2.7 reports an exception from here past the last result,
+        # and the results then never end; so it is kept for later.
+        try:
+            for task in tasks:
+                slots.acquire()
+                if len(stop) != 0:
+                    return
+                yield task
+        except Exception as e:
+            feed_failure.append(e)
+    results = pool.imap(func, feed())
+    failure = None
+    interrupted = False
+    try:
+        while len(stop) == 0:
+            try:
+                result = _next_result(results)
+            except StopIteration:
+                break
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                failure = e
+                break
+            slots.release()
+            if failed is not None and failed(result):
+                stop.append(True)
+            yield result
+    except KeyboardInterrupt:
+        interrupted = True
+        raise
+    finally:
+        stop.append(True)
+        slots.release()
+        try:
+            while not interrupted:
                 try:
-                    encoded_data = encode_line(line)
-                except GcodeSyntaxError as e:
-                    e.args = ('line {}: {}'.format(line_num, e.args[0]),)
+                    _next_result(results)
+                except StopIteration:
+                    break
+                except KeyboardInterrupt:
                     raise
-                output_file.write(encoded_data)
-            output_file.write(chr(0xE0))
+                except Exception:
+                    pass
+        except KeyboardInterrupt:
+            interrupted = True
+            raise
+        finally:
+            if interrupted:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+    if failure is None and len(feed_failure) != 0:
+        failure = feed_failure[0]
+    if failure is not None:
+        raise failure
+
+def _next_result(results):
+    import multiprocessing
+    while True:
+        try:
+            return results.next(PoolWaitTimeout)
+        except multiprocessing.TimeoutError:
+            pass
+
+def _split_at_lines(input_file, chunk_size):
+    file_size = os.fstat(input_file.fileno()).st_size
+    start = 0
+    while start < file_size:
+        end = start + chunk_size
+        if end >= file_size:
+            end = file_size
+        else:
+            input_file.seek(end)
+            end += len(input_file.readline())
+        yield (start, end)
+        start = end
+
+def _encode_chunk(chunk):
+    # Runs in a worker process. Returns the packets, the number of lines
+    # encoded (including the failing one), the syntax error message if any
+    # and the cache hit and miss counts.
+    file_name, start, end, cache_size, bulk, delta = chunk
+    with open(file_name, "rb") as input_file:
+        data = map_input(input_file)
+    output_file = io.BytesIO()
+    cache = PacketCache(cache_size) if cache_size > 0 else None
+    writer = PacketWriter(output_file, cache=cache, delta=delta)
+    line_count, error = _encode_lines(iter_mapped_lines(data, start, end), writer, bulk)
+    writer.flush()
+    cache_counts = (0, 0) if cache is None else (cache.hits, cache.misses)
+    return (output_file.getvalue(), line_count, error, cache_counts)
+
+def _encode_lines(lines, writer, bulk=False):
+    # Encodes lines until the end or a syntax error. Returns the number of
+    # lines consumed (including the failing one) and the error message or None.
+    if bulk:
+        return _encode_lines_bulk(lines, writer)
+    line_count = 0
+    try:
+        for line in lines:
+            line_count += 1
+            writer.write_line(line)
+    except GcodeSyntaxError as e:
+        return (line_count, e.args[0])
+    return (line_count, None)
+
+def _encode_lines_bulk(lines, writer):
+    # Lines starting with G0/G1 are packed together with NumPy. The other
+    # lines of a run go through the scalar encoder, and their packets are
+    # put in between the packed moves, so comments, fan commands and such
+    # do not end the run.
+    import numpy
+    tables = _CharTables(numpy)
+    line_count = 0
+    run = []
+    moves = []
+    others = []
+    for line in lines:
+        run.append(line)
+        if line[:3] in _MoveStarts:
+            moves.append(line)
+        elif line[:1] != ';':
+            others.append((len(moves), line))
+        if len(run) < BulkRunSize:
+            continue
+        run_count, error = _encode_move_run(run, moves, others, writer, numpy, tables)
+        line_count += run_count
+        if error is not None:
+            return (line_count, error)
+        run = []
+        moves = []
+        others = []
+    run_count, error = _encode_move_run(run, moves, others, writer, numpy, tables)
+    line_count += run_count
+    return (line_count, error)
+
+def _encode_move_run(run, moves, others, writer, numpy, tables):
+    # Run has all the lines, moves those starting with G0/G1, and others the
+    # rest which are not comments, with the number of moves before each.
+    packed = None
+    if len(moves) >= BulkMinRunSize:
+        packed = _pack_move_run(moves, numpy, tables)
+    if packed is None:
+        # Something the bulk path does not handle (or an error), let the
+        # scalar encoder deal with it.
+        return _encode_lines(run, writer)
+    data, packet_starts = packed
+    if len(others) > 0:
+        buf = bytearray(MaxPacketSize)
+        parts = []
+        prev = 0
+        try:
+            for (move_index, line) in others:
+                end = writer.encode_into(line, buf, 0)
+                if end == 0:
+                    continue
+                cut = len(data) if move_index == len(moves) else int(packet_starts[move_index])
+                parts.append(data[prev:cut])
+                parts.append(str(buf[:end]))
+                prev = cut
+        except GcodeSyntaxError:
+            return _encode_lines(run, writer)
+        parts.append(data[prev:])
+        data = ''.join(parts)
+    writer.write_packets(data)
+    return (len(run), None)
+
+def _pack_move_run(run, numpy, tables):
+    # The run is tokenized as one character array: comments and whitespace
+    # are masked out, parameter tokens are classified by counting character
+    # classes, and all numbers are parsed by a single numpy.fromstring().
+    # Packets are then assembled by scattering header, index and value bytes
+    # to their computed offsets. Returns the packets and the offset of each,
+    # or None if the run contains anything which needs the scalar encoder
+    # (including errors).
+    text = '\n'.join(run) + '\n'
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    num_chars = len(chars)
+    line_ends = numpy.flatnonzero(chars == ord('\n'))
+    line_starts = numpy.concatenate(([0], line_ends[:-1] + 1))
+    line_ids = numpy.repeat(numpy.arange(len(run)), line_ends - line_starts + 1)
+    
+    is_space = tables.space[chars]
+    if ';' in text:
+        semicolons = numpy.cumsum(chars == ord(';'), dtype=numpy.int32)
+        semicolons_before_line = semicolons[line_starts] - (chars[line_starts] == ord(';'))
+        is_space |= semicolons > semicolons_before_line[line_ids]
+    is_prev_space = numpy.concatenate(([True], is_space[:-1]))
+    is_next_space = numpy.concatenate((is_space[1:], [True]))
+    token_starts = numpy.flatnonzero(~is_space & is_prev_space)
+    token_ends = numpy.flatnonzero(~is_space & is_next_space) + 1
+    token_lines = line_ids[token_starts]
+    
+    # The first token of each line is the G0/G1 command, the rest are parameters.
+    tokens_per_line = numpy.bincount(token_lines, minlength=len(run))
+    num_params = tokens_per_line - 1
+    if num_params.max() > 14:
+        return None
+    is_param = numpy.ones(len(token_starts), dtype=bool)
+    is_param[numpy.cumsum(tokens_per_line) - tokens_per_line] = False
+    param_starts = token_starts[is_param]
+    param_ends = token_ends[is_param]
+    param_lines = token_lines[is_param]
+    letter_codes = chars[param_starts].astype(numpy.intp) - ord('A')
+    if ((letter_codes < 0) | (letter_codes > 25)).any():
+        return None
+    
+    value_starts = param_starts + 1
+    value_lengths = param_ends - value_starts
+    digits = numpy.concatenate(([0], numpy.cumsum(tables.digit[chars], dtype=numpy.int32)))
+    real_chars = numpy.concatenate(([0], numpy.cumsum(tables.real[chars], dtype=numpy.int32)))
+    value_digits = digits[param_ends] - digits[value_starts]
+    value_real_chars = real_chars[param_ends] - real_chars[value_starts]
+    is_void = value_lengths == 0
+    is_integer = ~is_void & (value_digits == value_lengths)
+    is_real = ~is_void & ~is_integer
+    if (is_integer & (value_lengths > 9)).any() or (is_real & (value_real_chars != value_lengths)).any():
+        return None
+    if (is_real & (value_digits == value_lengths - 1) & tables.sign[chars[numpy.minimum(value_starts, num_chars - 1)]]).any():
+        return None
+    
+    is_valued = ~is_void
+    keep = numpy.zeros(num_chars, dtype=numpy.int8)
+    keep[value_starts[is_valued]] = 1
+    keep[param_ends[is_valued]] = -1
+    keep = numpy.cumsum(keep, dtype=numpy.int8) > 0
+    # The trailing 0 guards against a parse which stops early.
+    number_text = numpy.where(keep, chars, ord(' ')).astype(numpy.uint8).tobytes() + ' 0'
+    num_values = int(is_valued.sum())
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            numbers = numpy.fromstring(number_text, dtype=numpy.float64, sep=' ')
+        except ValueError:
+            return None
+    if len(numbers) != num_values + 1:
+        return None
+    numbers = numbers[:-1]
+    valued_is_real = is_real[is_valued]
+    with numpy.errstate(over='ignore', invalid='ignore'):
+        floats = numbers.astype('<f4')
+    if (numpy.isinf(floats) != numpy.isinf(numbers)).any():
+        return None
+    words = numpy.where(valued_is_real, floats.view('<u4'), numbers.astype('<u4'))
+    
+    values_per_line = numpy.bincount(param_lines[is_valued], minlength=len(run))
+    packet_sizes = 1 + num_params + 4 * values_per_line
+    packet_starts = numpy.cumsum(packet_sizes) - packet_sizes
+    output = numpy.empty(int(packet_sizes.sum()), dtype=numpy.uint8)
+    command_codes = chars[line_starts + 1].astype(numpy.intp) - ord('0') + 1
+    output[packet_starts] = (command_codes << 4) + num_params
+    type_codes = numpy.where(is_void, 5, numpy.where(is_integer, 3, 1))
+    param_ranks = numpy.arange(len(param_starts)) - (numpy.cumsum(num_params) - num_params)[param_lines]
+    output[packet_starts[param_lines] + 1 + param_ranks] = (type_codes << 5) + letter_codes
+    valued_lines = param_lines[is_valued]
+    value_ranks = numpy.arange(num_values) - (numpy.cumsum(values_per_line) - values_per_line)[valued_lines]
+    value_dest = packet_starts[valued_lines] + 1 + num_params[valued_lines] + 4 * value_ranks
+    output[(value_dest[:, None] + numpy.arange(4)).ravel()] = words.view(numpy.uint8)
+    return (output.tobytes(), packet_starts)
 
 _SmallCommands = {
     ('G', 0) : 1,
@@ -99,16 +822,105 @@ _SmallCommands = {
     ('G', 92) : 3
 }
 
-def _letter_ok(ch):
-    return (ord(ch) >= ord('A') and ord(ch) <= ord('Z'))
+_CommandHeaders = {}
+_MaxCommandHeaders = 1024
+
+_LetterCodes = dict((chr(ord('A') + i), i) for i in range(26))
+
+_MoveStarts = frozenset(['G0 ', 'G1 '])
+
+class _CharTables(object):
+    def __init__(self, numpy):
+        self.space = numpy.array([chr(i) in ' \t\n\r\x0b\x0c' for i in range(256)])
+        self.digit = numpy.array([chr(i).isdigit() for i in range(256)])
+        self.real = numpy.array([chr(i) in '0123456789.+-eE' for i in range(256)])
+        self.sign = numpy.array([chr(i) in '+-' for i in range(256)])
+
+_Float = struct.Struct('<f')
+_Uint32 = struct.Struct('<I')
+_Uint64 = struct.Struct('<Q')
+_Int16 = struct.Struct('<h')
+_PayloadStructs = [None, _Float, None, _Uint32, _Uint64]
+_PayloadSizes = [None, 4, 8, 4, 8, 0]
+
+_Infinity = float('inf')
+_NaN = float('nan')
+_FeedrateLetterCode = _LetterCodes['F']
+_ZLetterCode = _LetterCodes['Z']
+_ExtrudeMask = (1 << _LetterCodes['E']) | (1 << _LetterCodes['U']) | (1 << _LetterCodes['V'])
+_PlaneMask = (1 << _LetterCodes['X']) | (1 << _LetterCodes['Y'])
+
+def _make_command_header(cmd):
+    cmd_letter = cmd[0]
+    if cmd_letter not in _LetterCodes:
+        raise GcodeSyntaxError('invalid command letter')
+    try:
+        cmd_number = int(cmd[1:])
+    except ValueError:
+        raise GcodeSyntaxError('invalid command number')
+    if not (cmd_number >= 0 and cmd_number < 2048):
+        raise GcodeSyntaxError('invalid command number')
+    if (cmd_letter, cmd_number) in _SmallCommands:
+        header = (_SmallCommands[(cmd_letter, cmd_number)], None)
+    else:
+        header = (15, struct.pack('BB', (_LetterCodes[cmd_letter] << 3) + (cmd_number >> 8), cmd_number & 0xFF))
+    if len(_CommandHeaders) < _MaxCommandHeaders:
+        _CommandHeaders[cmd] = header
+    return header
+
+_HeaderG28 = _make_command_header('G28')[1]
+_HeaderG90 = _make_command_header('G90')[1]
+_HeaderG91 = _make_command_header('G91')[1]
 
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='G-code packet for APrinter firmware.')
-    parser.add_argument('--input', required=True)
-    parser.add_argument('--output', required=True)
+    parser.add_argument('--input', required=True, help='Input file, or - for stdin with --live.')
+    parser.add_argument('--output', required=True, help='Output file, or - for stdout with --live.')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of encoder processes.')
+    parser.add_argument('--cache-size', type=int, default=0, help='Number of repeated lines to remember, e.g. {} (default 0, disabled).'.format(DefaultCacheSize))
+    parser.add_argument('--stats', action='store_true', help='Print cache statistics.')
+    parser.add_argument('--numpy', action='store_true', help='Pack runs of G0/G1 moves using NumPy.')
+    parser.add_argument('--delta', action='store_true', help='Encode moves as 16-bit deltas (needs decoder support).')
+    parser.add_argument('--live', action='store_true', help='Encode a pipe or FIFO as it is written, flushing regularly.')
+    parser.add_argument('--max-latency', type=float, default=DefaultMaxLatency, help='Maximum seconds between encoding and output in --live mode.')
+    parser.add_argument('--index', help='Write a sidecar index for seeking to lines and layers to this file.')
+    parser.add_argument('--index-interval', type=int, default=DefaultIndexInterval, help='Packets between index checkpoints.')
     args = parser.parse_args()
-    encode_file(args.input, args.output)
+    if args.index is not None and (args.jobs != 1 or args.numpy):
+        parser.error('--index cannot be combined with --jobs or --numpy')
+    if args.index_interval < 1:
+        parser.error('--index-interval must be at least 1')
+    if args.live and (args.jobs != 1 or args.numpy):
+        parser.error('--live cannot be combined with --jobs or --numpy')
+    if not args.live and '-' in (args.input, args.output):
+        parser.error('stdin/stdout can only be used with --live')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.cache_size == 1 or args.cache_size < 0:
+        parser.error('--cache-size must be 0 or at least 2')
+    if args.numpy and args.delta:
+        parser.error('--numpy cannot be combined with --delta')
+    if args.numpy:
+        try:
+            import numpy
+        except ImportError:
+            parser.error('--numpy requires NumPy')
+    index = IndexBuilder(args.index_interval) if args.index is not None else None
+    if args.live:
+        cache = PacketCache(args.cache_size) if args.cache_size > 0 else None
+        input_file = sys.stdin if args.input == '-' else open(args.input, "rb")
+        output_file = os.fdopen(os.dup(sys.stdout.fileno()), "wb") if args.output == '-' else open(args.output, "wb")
+        with input_file:
+            with output_file:
+                encode_live(input_file, output_file, max_latency=args.max_latency, cache=cache, delta=args.delta, index=index)
+    else:
+        cache = encode_file(args.input, args.output, jobs=args.jobs, cache_size=args.cache_size, bulk=args.numpy, delta=args.delta, index=index)
+    if index is not None:
+        with open(args.index, "wb") as index_file:
+            index.write(index_file)
+    if args.stats and cache is not None:
+        print('Cache: {} hits, {} misses'.format(cache.hits, cache.misses))
 
 if __name__ == '__main__':
     main()
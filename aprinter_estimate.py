@@ -0,0 +1,378 @@
+#!/usr/bin/env python2.7
+
+# Print time and filament estimation for DeTool.py --estimate. The limits
+# come from the APRINTER_CONFIG_OPTION_DOUBLE values of a board's main file
+# (XMaxSpeed, XMaxAccel, XDistanceFactor, XCorneringDistance, and so on for
+# each axis). Moves are planned like the firmware's motion planner does:
+# each move is limited by the feedrate and by the speed and acceleration
+# limits of its axes, the speed at the junction of two moves by how much
+# the direction of each axis changes, and the speed profile of each move is
+# a trapezoid. As in the firmware, each junction's speed must allow
+# stopping within the moves in its look-ahead buffer (LookaheadBufferSize
+# of the main file). The firmware plans as moves arrive, while this plans
+# each block of moves at once, in one backward and one forward pass.
+# Homing (G28) takes no time here, and dwells (G4) are counted.
+# Filament that is retracted and then pushed back counts as retracted, not
+# as extruded. Relative extrusion (M83) is followed, with a warning, as the
+# firmware does not support M82/M83 and would take the E values as absolute.
+
+from __future__ import print_function
+from __future__ import with_statement
+import re
+import math
+import array
+
+FeedrateTimeUnit = 60.0
+PlanBlockSize = 2**16
+
+_Infinity = float('inf')
+_ConfigOption = re.compile(r'APRINTER_CONFIG_OPTION_DOUBLE\(\s*(\w+)\s*,\s*([^,]+),')
+_ConfigValue = re.compile(r'^[0-9eE.+\-*/() ]+$')
+_LookaheadOption = re.compile(r'(\d+)\s*,\s*//\s*LookaheadBufferSize\b')
+
+def read_board_limits(main_file_name):
+    # Returns {axis: (max_speed, max_accel, distance_factor, cornering_distance)}
+    # for each axis whose MaxSpeed and MaxAccel are in the file.
+    options = {}
+    with open(main_file_name, "r") as f:
+        for match in _ConfigOption.finditer(f.read()):
+            text = match.group(2).strip()
+            if _ConfigValue.match(text):
+                options[match.group(1)] = float(eval(text, {'__builtins__': {}}))
+    limits = {}
+    for axis in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        if axis + 'MaxSpeed' in options and axis + 'MaxAccel' in options:
+            limits[axis] = (options[axis + 'MaxSpeed'], options[axis + 'MaxAccel'],
+                            options.get(axis + 'DistanceFactor', 1.0), options.get(axis + 'CorneringDistance', _Infinity))
+    if len(limits) == 0:
+        raise ValueError('no axis limits found in {}'.format(main_file_name))
+    return limits
+
+def read_board_lookahead(main_file_name):
+    # Returns the LookaheadBufferSize in the file, or None if there is none.
+    with open(main_file_name, "r") as f:
+        match = _LookaheadOption.search(f.read())
+    return None if match is None else int(match.group(1))
+
+class MoveEstimator(object):
+    # Collects moves as per-axis deltas and plans them in blocks. Between
+    # blocks, and at stop(), the speed goes down to zero. Lookahead is the
+    # number of moves the planner sees ahead (None for no limit).
+
+    def __init__(self, limits, cartesian_axes='XYZ', lookahead=None):
+        self.limits = limits
+        self.cartesian_axes = cartesian_axes
+        self.lookahead = lookahead
+        self.seconds = 0.0
+        self.dwell_seconds = 0.0
+        self.moves = 0
+        self.layers = []
+        self.layer_seconds = array.array('d')
+        self.tools = {}
+        self.warnings = []
+        self._max_z = None
+        self._retraction = {}
+        self._axes = {}
+        self._last_dir = {}
+        self._last_max_v2 = 0.0
+        # (length, max_v2, accel, junction_v2, layer, tool stats) of the
+        # moves not planned yet.
+        self._block = []
+
+    def add_move(self, deltas, feedrate, tool, extruder, z):
+        # Deltas maps axis names to the nonzero changes in position, feedrate
+        # is in units per minute, and extruder is the axis name of the tool.
+        axes = self._axes
+        cartesian = 0.0
+        distance = 0.0
+        for (axis, delta) in deltas.iteritems():
+            axis_params = axes.get(axis)
+            if axis_params is None:
+                axis_params = self._axis_params(axis)
+            if axis_params[0]:
+                cartesian += delta * delta
+            delta *= axis_params[1]
+            distance += delta * delta
+        if distance == 0.0:
+            return
+        distance = math.sqrt(distance)
+        speed = feedrate / FeedrateTimeUnit
+        if speed <= 0.0:
+            min_time = 0.0
+        elif cartesian > 0.0:
+            min_time = math.sqrt(cartesian) / speed
+        else:
+            min_time = max([abs(delta) for delta in deltas.itervalues()]) / speed
+        distance_rec = 1.0 / distance
+        accel = _Infinity
+        junction_v2 = _Infinity
+        last_dir = self._last_dir
+        direction = {}
+        for (axis, delta) in deltas.iteritems():
+            is_cartesian, distance_factor, max_speed_rec, max_accel, corner_factor = axes[axis]
+            unit = delta * distance_rec
+            direction[axis] = unit
+            change = unit - last_dir.get(axis, 0.0)
+            if change != 0.0:
+                limit = corner_factor / abs(change)
+                if limit < junction_v2:
+                    junction_v2 = limit
+            if unit < 0.0:
+                unit = -unit
+                delta = -delta
+            time = delta * max_speed_rec
+            if time > min_time:
+                min_time = time
+            limit = max_accel / unit
+            if limit < accel:
+                accel = limit
+        for (axis, unit) in last_dir.iteritems():
+            if axis not in direction:
+                limit = axes[axis][4] / abs(unit)
+                if limit < junction_v2:
+                    junction_v2 = limit
+        self._last_dir = direction
+        max_v2 = (distance / min_time) ** 2 if min_time > 0.0 else _Infinity
+        extruded = deltas.get(extruder, 0.0)
+        if extruded > 0.0 and z is not None and (self._max_z is None or z > self._max_z) and \
+                (deltas.get('X', 0.0) != 0.0 or deltas.get('Y', 0.0) != 0.0):
+            # A printing move at a new height starts a layer.
+            self._max_z = z
+            self.layers.append(z)
+            self.layer_seconds.append(0.0)
+        tool_stats = self.tools.get(tool)
+        if tool_stats is None:
+            tool_stats = self.tools[tool] = {'extruded': 0.0, 'retracted': 0.0, 'seconds': 0.0, 'moves': 0}
+        # How far each extruder is retracted, which unretracts give back.
+        retraction = self._retraction.get(extruder, 0.0)
+        if extruded > 0.0:
+            unretracted = min(extruded, retraction)
+            self._retraction[extruder] = retraction - unretracted
+            tool_stats['extruded'] += extruded - unretracted
+        else:
+            self._retraction[extruder] = retraction - extruded
+            tool_stats['retracted'] -= extruded
+        tool_stats['moves'] += 1
+        # As in the firmware, the junction is also limited by the maximum
+        # speed of both moves.
+        if max_v2 < junction_v2:
+            junction_v2 = max_v2
+        if self._last_max_v2 < junction_v2:
+            junction_v2 = self._last_max_v2
+        self._last_max_v2 = max_v2
+        block = self._block
+        block.append((distance, max_v2, accel, junction_v2, len(self.layers) - 1, tool_stats))
+        if len(block) >= PlanBlockSize:
+            self._plan()
+
+    def _axis_params(self, axis):
+        # (cartesian, distance factor, 1 / max speed, max accel, max accel
+        # times cornering distance), without limits for unknown axes.
+        if axis in self.limits:
+            max_speed, max_accel, distance_factor, cornering = self.limits[axis]
+            axis_params = (axis in self.cartesian_axes, distance_factor, 1.0 / max_speed, max_accel, max_accel * cornering)
+        else:
+            axis_params = (axis in self.cartesian_axes, 1.0, 0.0, _Infinity, _Infinity)
+        self._axes[axis] = axis_params
+        return axis_params
+
+    def warn(self, message):
+        if message not in self.warnings:
+            self.warnings.append(message)
+
+    def dwell(self, seconds):
+        self.stop()
+        self.dwell_seconds += seconds
+        self.seconds += seconds
+        if len(self.layer_seconds) > 0:
+            self.layer_seconds[-1] += seconds
+
+    def stop(self):
+        # The printer comes to a standstill, as for homing or a dwell.
+        self._plan()
+        self._last_dir = {}
+        self._last_max_v2 = 0.0
+
+    def finish(self):
+        self.stop()
+        return self
+
+    def _plan(self):
+        block = self._block
+        count = len(block)
+        if count == 0:
+            return
+        # Squared speeds at the start of each move and at the end of the last.
+        # The start speed is limited by the junction, and by stopping within
+        # the moves after it: all of them, or as many as the firmware's
+        # look-ahead holds. That window is kept as a running sum, with the
+        # moves without an acceleration limit counted separately.
+        start_v2 = [0.0] * (count + 1)
+        end_v2 = 0.0
+        lookahead = self.lookahead
+        if lookahead is None:
+            lookahead = count
+        reach = [0.0] * (count + lookahead)
+        window = 0.0
+        unlimited = 0
+        for i in range(count - 1, -1, -1):
+            length, max_v2, accel, junction_v2, layer, tool_stats = block[i]
+            move_reach = 2.0 * accel * length
+            reach[i] = move_reach
+            end_v2 += move_reach
+            if end_v2 > junction_v2:
+                end_v2 = junction_v2
+            if move_reach == _Infinity:
+                unlimited += 1
+            else:
+                window += move_reach
+            dropped = reach[i + lookahead]
+            if dropped == _Infinity:
+                unlimited -= 1
+            else:
+                window -= dropped
+            if unlimited == 0 and end_v2 > window:
+                end_v2 = window
+            start_v2[i] = end_v2
+        start_v2[0] = 0.0
+        layer_seconds = self.layer_seconds
+        total = 0.0
+        sqrt = math.sqrt
+        for i in range(count):
+            length, max_v2, accel, junction_v2, layer, tool_stats = block[i]
+            start = start_v2[i]
+            end = start_v2[i + 1]
+            limit = start + reach[i]
+            if end > limit:
+                start_v2[i + 1] = end = limit
+            # The time of the trapezoid speed profile.
+            if accel == _Infinity:
+                move_seconds = length / sqrt(max_v2)
+            else:
+                peak_v2 = 0.5 * (start + end) + accel * length
+                if peak_v2 > max_v2:
+                    peak_v2 = max_v2
+                peak_v = sqrt(peak_v2)
+                cruise = length - (2.0 * peak_v2 - start - end) / (2.0 * accel)
+                move_seconds = (2.0 * peak_v - sqrt(start) - sqrt(end)) / accel
+                if cruise > 0.0:
+                    move_seconds += cruise / peak_v
+            total += move_seconds
+            if layer >= 0:
+                layer_seconds[layer] += move_seconds
+            tool_stats['seconds'] += move_seconds
+        self.seconds += total
+        self.moves += count
+        self._block = []
+
+    def as_dict(self):
+        return {
+            'seconds': self.seconds,
+            'dwellSeconds': self.dwell_seconds,
+            'moves': self.moves,
+            'tools': dict([(str(tool), stats) for (tool, stats) in self.tools.items()]),
+            'layers': [{'z': z, 'seconds': seconds} for (z, seconds) in zip(self.layers, self.layer_seconds)],
+            'warnings': list(self.warnings),
+        }
+
+    def format_summary(self):
+        rows = ['Estimated time: {} ({} moves, {:.1f} s dwell)'.format(format_duration(self.seconds), self.moves, self.dwell_seconds)]
+        for tool in sorted(self.tools):
+            stats = self.tools[tool]
+            rows.append('T{}: {:.1f} mm extruded, {:.1f} mm retracted, {} moves, {}'.format(
+                tool, stats['extruded'], stats['retracted'], stats['moves'], format_duration(stats['seconds'])))
+        if len(self.layers) > 0:
+            seconds = list(self.layer_seconds)
+            rows.append('Layers: {}, {} to {} each ({} average)'.format(
+                len(seconds), format_duration(min(seconds)), format_duration(max(seconds)), format_duration(sum(seconds) / len(seconds))))
+        for warning in self.warnings:
+            rows.append('Warning: {}'.format(warning))
+        return '\n'.join(rows)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(seconds, 60.0)
+    hours, minutes = divmod(int(minutes), 60)
+    if hours > 0:
+        return '{}h{:02d}m{:02.0f}s'.format(hours, minutes, math.floor(seconds))
+    if minutes > 0:
+        return '{}m{:02.0f}s'.format(minutes, math.floor(seconds))
+    return '{:.2f}s'.format(seconds)
+
+class DeToolEstimate(object):
+    # Feeds the moves of a DeTool run into a MoveEstimator, by wrapping the
+    # instance's move core and its G28 handler and adding ones for G4, M82
+    # and M83 (which are passed through). An unwrapped DeTool pays nothing
+    # for this.
+
+    def __init__(self, deTool, estimator):
+        self.deTool = deTool
+        self.estimator = estimator
+        self.relativeE = False
+        self._moveCore = deTool._move_core
+        deTool._move_core = self._move_core
+        for handlers in (deTool.handlers, deTool.scanHandlers):
+            home = handlers['G28']
+            handlers['G28'] = self._wrap_stop(home)
+            handlers['G4'] = self._dwell
+            handlers['M82'] = self._absolute_e
+            handlers['M83'] = self._relative_e
+
+    def _move_core(self, state, comps):
+        oldPos = state.physPos.copy()
+        known = state.known.copy()
+        oldE = state.reqPos['E']
+        result = self._moveCore(state, comps)
+        tool = state.tool
+        extruder = self.deTool.tools[tool]['name']
+        travelAxes = result[0]
+        if len(travelAxes) > 0:
+            travelPos = oldPos.copy()
+            for (axisName, position) in travelAxes:
+                travelPos[axisName] = position
+            self._add(oldPos, travelPos, known, {}, self.deTool.config.toolTravelSpeed * FeedrateTimeUnit, tool, extruder, state)
+            oldPos = travelPos
+        deltas = {}
+        if self.relativeE and not state.relative:
+            # DeTool takes the E values as absolute, so its E position is
+            # the last one given.
+            for comp in comps[1:]:
+                if comp[:1] == 'E' and float(comp[1:]) != 0.0:
+                    deltas[extruder] = float(comp[1:])
+        elif state.reqPos['E'] != oldE:
+            deltas[extruder] = state.reqPos['E'] - oldE
+        self._add(oldPos, state.physPos, known, deltas, state.feedrate, tool, extruder, state)
+        return result
+
+    def _add(self, oldPos, newPos, known, deltas, feedrate, tool, extruder, state):
+        for axisName in newPos:
+            # Moves from an unknown position (after homing) are not counted.
+            if known[axisName] and newPos[axisName] != oldPos[axisName]:
+                deltas[axisName] = newPos[axisName] - oldPos[axisName]
+        # Layers go by the Z of the source, which does not have the tool offsets.
+        z = state.reqPos['Z'] if state.known['Z'] else None
+        self.estimator.add_move(deltas, feedrate, tool, extruder, z)
+
+    def _wrap_stop(self, handler):
+        def stop(state, comps):
+            self.estimator.stop()
+            return handler(state, comps)
+        return stop
+
+    def _dwell(self, state, comps):
+        seconds = 0.0
+        for comp in comps[1:]:
+            if comp[:1] == 'P':
+                seconds = float(comp[1:]) / 1000.0
+            elif comp[:1] == 'S':
+                seconds = float(comp[1:])
+        self.estimator.dwell(seconds)
+        return None
+
+    def _absolute_e(self, state, comps):
+        self.relativeE = False
+        return None
+
+    def _relative_e(self, state, comps):
+        self.relativeE = True
+        self.estimator.warn('relative extrusion (M83) is not supported by the firmware, which will take the E values as absolute')
+        return None
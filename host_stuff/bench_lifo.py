@@ -0,0 +1,60 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import sys
+import argparse
+import random
+import time
+import littlevent.close
+import littlevent.loop
+
+# Stress benchmark for the pending LifoEvent queue of littlevent.loop.Loop.
+# Each round pushes all events, re-pushes them in random order (as fds
+# becoming ready again do) and removes some, then lets the loop run them.
+# With --list, the loop uses a plain list like it used to, for comparison.
+
+class Program (littlevent.close.Obj):
+    def __init__ (self, args):
+        littlevent.close.Obj.__init__(self)
+        self.loop = self.add(littlevent.loop.Loop())
+        if args.list:
+            self.loop.pending_lifo = []
+        self.events = [self.add(littlevent.loop.LifoEvent(self.loop, self._handler)) for i in range(args.events)]
+        self.rounds = args.rounds
+        self.handled = 0
+        self.random = random.Random(0)
+
+    def _handler (self):
+        self.handled += 1
+
+    def run (self):
+        order = list(self.events)
+        start_time = time.time()
+        for i in range(self.rounds):
+            for lifo_event in self.events:
+                lifo_event.push()
+            self.random.shuffle(order)
+            for lifo_event in order:
+                lifo_event.push()
+            for lifo_event in order[::4]:
+                lifo_event.remove()
+            self.loop._process_lifo()
+        return time.time() - start_time
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmark the littlevent LifoEvent queue.')
+    parser.add_argument('--events', type=int, default=5000, help='Number of events.')
+    parser.add_argument('--rounds', type=int, default=10, help='Number of rounds.')
+    parser.add_argument('--list', action='store_true', help='Use a plain list for the pending events.')
+    args = parser.parse_args()
+
+    p = Program(args)
+    total_time = p.run()
+    p.close()
+
+    operations = args.rounds * (2 * args.events + (args.events + 3) // 4 + p.handled // args.rounds)
+    print('{} events, {} rounds: {} handled in {:.3f} seconds.'.format(args.events, args.rounds, p.handled, total_time))
+    print('{:.2f} microseconds per push, remove or pop.'.format(total_time / operations * 1e6))
+
+if __name__ == '__main__':
+    main()
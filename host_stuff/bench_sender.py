@@ -0,0 +1,86 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import sys
+import argparse
+import littlevent.close
+import littlevent.error
+import littlevent.loop
+import littlevent.serial
+import gcode_sender
+import fake_printer
+
+# Compares the commands per second of GcodeSender stopping and waiting for
+# each ok against keeping the firmware's receive buffer full, with a fake
+# printer on a pty pair in the same process.
+
+class Run (littlevent.close.Obj):
+    def __init__ (self, args, window_bytes, max_commands):
+        littlevent.close.Obj.__init__(self)
+        try:
+            self.loop = self.add(littlevent.loop.Loop())
+            self.printer = self.add(fake_printer.FakePrinter(self.loop, args.delay, self._error_handler, args.latency, 2**args.recv_buffer_exp - 1, args.error_rate))
+            self.serial = self.add(littlevent.serial.Serial(self.loop, self.printer.path(), args.baud, self._error_handler))
+        except littlevent.error.Error:
+            self.close()
+            raise
+        self.remaining = args.count
+        self.sender = gcode_sender.GcodeSender(self.serial.read_io(), self.serial.write_io(), self._source, self._finished_handler, window_bytes, max_commands)
+    
+    def _source (self):
+        if self.remaining == 0:
+            return None
+        self.remaining -= 1
+        return 'G1 X{:.3f} Y{:.3f} E{:.5f}'.format(self.remaining % 200 * 0.5, self.remaining % 170 * 0.5, self.remaining * 0.01)
+    
+    def _error_handler (self, err):
+        print('ERROR: {}'.format(err))
+        self.loop.quit(1)
+    
+    def _finished_handler (self, error):
+        if error is not None:
+            print('ERROR: {}'.format(error))
+        self.loop.quit(0 if error is None else 1)
+    
+    def run (self):
+        start_time = self.loop.time()
+        self.sender.start()
+        ret = self.loop.run()
+        return (ret, self.loop.time() - start_time)
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmark windowed g-code sending against stop and wait.')
+    parser.add_argument('--count', type=int, default=2000, help='Number of commands.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Round trip seconds of the fake link.')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds each command takes on the fake printer.')
+    parser.add_argument('--recv-buffer-exp', type=int, default=8, help='RecvBufferSizeExp of the fake firmware.')
+    parser.add_argument('--board', metavar='BoardMainFile', help='Take RecvBufferSizeExp from this board\'s main file.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of commands which fail as garbled.')
+    parser.add_argument('--baud', type=int, default=250000, help='Baud rate.')
+    args = parser.parse_args()
+    if args.board is not None:
+        try:
+            args.recv_buffer_exp = gcode_sender.read_recv_buffer_size_exp(args.board)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    
+    window_bytes = 2**args.recv_buffer_exp - 1
+    results = []
+    for (name, max_commands) in (('stop-and-wait', 1), ('windowed', None)):
+        try:
+            run = Run(args, window_bytes, max_commands)
+        except littlevent.error.Error as e:
+            print('ERROR: {}'.format(e))
+            sys.exit(1)
+        ret, seconds = run.run()
+        sender = run.sender
+        run.close()
+        if ret != 0:
+            sys.exit(ret)
+        rate = sender.commands_acked / seconds
+        results.append(rate)
+        print('{:<14} {:>7} cmds in {:7.3f} s, {:>9.1f} cmd/s, {} resent'.format(name, sender.commands_acked, seconds, rate, sender.commands_resent))
+    print('Window of {} bytes, {:.1f}x the commands per second.'.format(window_bytes, results[1] / results[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import os
+import sys
+import random
+import collections
+import tty
+import termios
+import argparse
+import littlevent.close
+import littlevent.error
+import littlevent.loop
+import littlevent.fd_io
+from gcode_sender import gcode_checksum
+
+# Pretend to be printers, for testing host programs without hardware. Each
+# FakePrinter owns a pty pair; the host opens the slave side (path()) like
+# a serial port, and every line it sends is answered with "ok" after the
+# given delay, one command at a time like the firmware. Line numbers and
+# checksums are checked like the firmware does, and error_rate makes that
+# fraction of the commands fail as if garbled. Replies can be held back by
+# a latency, for the round trip of a real link. With recv_buffer_size, the
+# bytes of the commands not yet done must fit in a buffer of that size, as
+# in the firmware, or the printer fails with an overrun.
+
+class FakePrinter (littlevent.close.Obj):
+    def __init__ (self, loop, delay, error_handler, latency=0.0, recv_buffer_size=None, error_rate=0.0):
+        littlevent.close.Obj.__init__(self)
+        try:
+            try:
+                master_fd, slave_fd = os.openpty()
+            except OSError as e:
+                raise littlevent.error.Error(e)
+            # The slave stays open here too, so that the master does not see
+            # a hangup while the host has it closed.
+            self.slave_fd = slave_fd
+            self.add(lambda: os.close(slave_fd))
+            self.fd_io = self.add(littlevent.fd_io.FileDescriptor(loop, master_fd, True, error_handler))
+            try:
+                tty.setraw(slave_fd)
+            except termios.error as e:
+                raise littlevent.error.Error(e)
+            self.timer = self.add(littlevent.loop.Timer(loop, self._command_done))
+            self.reply_timer = self.add(littlevent.loop.Timer(loop, self._reply_timer_handler))
+        except littlevent.error.Error:
+            self.close()
+            raise
+        self.loop = loop
+        self.delay = delay
+        self.error_handler = error_handler
+        self.latency = latency
+        self.recv_buffer_size = recv_buffer_size
+        self.error_rate = error_rate
+        self.random = random.Random(0)
+        self.line_number = 0
+        self.buffered = 0
+        self.replies = collections.deque()
+        self.fd_io.read_set_handler(self._read_handler)
+        self.fd_io.write_set_handler(self._write_handler)
+        self.frame = ''
+        self.commands = collections.deque()
+        self.write_buffer = ''
+        self.writing = False
+        self.commands_done = 0
+        self.fd_io.read_start(4096)
+
+    def path (self):
+        return os.ttyname(self.slave_fd)
+
+    def _read_handler (self, data, err):
+        if err is not None:
+            return self.error_handler(err)
+        self.fd_io.read_start(4096)
+        lines = (self.frame + data).split('\n')
+        self.frame = lines.pop()
+        self.commands.extend(lines)
+        self.buffered += len(data)
+        if self.recv_buffer_size is not None and self.buffered > self.recv_buffer_size:
+            return self.error_handler('receive buffer overrun')
+        self._next_command()
+
+    def _next_command (self):
+        while len(self.commands) != 0 and not self.timer.pending():
+            if self.delay > 0:
+                self.timer.start(self.delay)
+            else:
+                self._finish_command()
+
+    def _command_done (self):
+        self._finish_command()
+        self._next_command()
+
+    def _finish_command (self):
+        command = self.commands.popleft()
+        self.buffered -= len(command) + 1
+        self.commands_done += 1
+        reply = self._execute(command)
+        if self.latency > 0:
+            self.replies.append((self.loop.time() + self.latency, reply))
+            if not self.reply_timer.pending():
+                self.reply_timer.start_at(self.replies[0][0])
+        else:
+            self._reply(reply)
+
+    def _execute (self, command):
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            return 'Error:incorrect checksum\nok\n'
+        checksum_pos = command.rfind('*')
+        if checksum_pos >= 0:
+            try:
+                checksum = int(command[checksum_pos + 1:])
+            except ValueError:
+                checksum = None
+            if checksum != gcode_checksum(command[:checksum_pos]):
+                return 'Error:incorrect checksum\nok\n'
+            command = command[:checksum_pos]
+        words = command.split()
+        number = None
+        if len(words) > 0 and words[0].startswith('N'):
+            number = int(words.pop(0)[1:])
+        is_m110 = words[:1] == ['M110']
+        if is_m110:
+            self.line_number = number if number is not None else -1
+        if number is not None and number != self.line_number:
+            return 'Error:Line Number is not Last Line Number+1, Last Line:{}\nok\n'.format(self.line_number - 1)
+        if number is not None or is_m110:
+            self.line_number += 1
+        return 'ok\n'
+
+    def _reply_timer_handler (self):
+        now = self.loop.time()
+        while len(self.replies) > 0 and self.replies[0][0] <= now:
+            self._reply(self.replies.popleft()[1])
+        if len(self.replies) > 0:
+            self.reply_timer.start_at(self.replies[0][0])
+
+    def _reply (self, data):
+        self.write_buffer += data
+        if not self.writing:
+            self._write()
+
+    def _write (self):
+        self.writing = True
+        data = self.write_buffer
+        self.write_buffer = ''
+        self.fd_io.write_start(data)
+
+    def _write_handler (self, err):
+        self.writing = False
+        if err is not None:
+            return self.error_handler(err)
+        if len(self.write_buffer) > 0:
+            self._write()
+
+def main ():
+    parser = argparse.ArgumentParser(description='Serve fake printers on pty pairs.')
+    parser.add_argument('--count', type=int, default=1, help='Number of printers.')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds each command takes.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each reply arrives.')
+    parser.add_argument('--recv-buffer-exp', type=int, help='Fail if the commands not yet done exceed 2**N-1 bytes.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of commands which fail as garbled.')
+    args = parser.parse_args()
+
+    loop = littlevent.loop.Loop()
+    closer = littlevent.close.Obj()
+    closer.add(loop)
+    def error_handler (err):
+        print('ERROR: {}'.format(err))
+        loop.quit(1)
+    try:
+        for i in range(args.count):
+            printer = closer.add(FakePrinter(loop, args.delay, error_handler, args.latency,
+                None if args.recv_buffer_exp is None else 2**args.recv_buffer_exp - 1, args.error_rate))
+            print(printer.path())
+    except littlevent.error.Error as e:
+        closer.close()
+        print('ERROR: {}'.format(e))
+        sys.exit(1)
+    sys.stdout.flush()
+    ret = loop.run()
+    closer.close()
+    sys.exit(ret)
+
+if __name__ == '__main__':
+    main()
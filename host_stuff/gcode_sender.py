@@ -0,0 +1,194 @@
+from __future__ import print_function
+import re
+import collections
+
+# Sends g-code commands over a littlevent.fd_io.FileDescriptor (or separate
+# read and write ones), keeping several commands in flight. The firmware
+# keeps the bytes of each command in its receive buffer until the command
+# is done and answered with "ok", so the commands in flight may take up to
+# window_bytes (2**RecvBufferSizeExp - 1 for the firmware's buffer) and at
+# most max_commands of them (None for no limit, 1 to stop and wait), but
+# not both limits may be None. Each ok gives back the credit of the oldest
+# command.
+#
+# Commands are numbered and checksummed (after an initial N0 M110), so
+# that the firmware rejects garbled ones. When a command fails with a
+# checksum, line number or overrun error, the firmware expects it again,
+# and the commands sent after it fail on their line numbers; they are all
+# sent again, up to max_resends times for one command.
+
+ResendErrors = ('Error:incorrect checksum', 'Error:Line Number is not', 'Error:receive buffer overrun')
+
+_RecvBufferSizeExp = re.compile(r'(\d+),\s*//\s*RecvBufferSizeExp')
+
+def read_recv_buffer_size_exp (main_file_name):
+    # The RecvBufferSizeExp of the serial port in a board's main file.
+    with open(main_file_name, 'r') as f:
+        match = _RecvBufferSizeExp.search(f.read())
+    if match is None:
+        raise ValueError('no RecvBufferSizeExp found in {}'.format(main_file_name))
+    return int(match.group(1))
+
+def gcode_checksum (data):
+    checksum = 0
+    for ch in data:
+        checksum ^= ord(ch)
+    return checksum
+
+class GcodeSender (object):
+    # source() returns the next command (without newline), or None at the
+    # end. finished_handler(error) is called once all commands have been
+    # answered (with error None), or on the first fatal error. Lines other
+    # than ok and errors go to response_handler, if given.
+    def __init__ (self, read_io, write_io, source, finished_handler, window_bytes, max_commands=None, numbered=True, max_resends=10, response_handler=None):
+        self.read_io = read_io
+        self.write_io = write_io
+        self.source = source
+        self.finished_handler = finished_handler
+        self.window_bytes = window_bytes
+        self.max_commands = max_commands
+        self.numbered = numbered
+        self.max_resends = max_resends
+        self.response_handler = response_handler
+        assert window_bytes is not None or max_commands is not None
+        self.read_io.read_set_handler(self._read_handler)
+        self.write_io.write_set_handler(self._write_handler)
+        self.frame = ''
+        self.write_buffer = ''
+        self.writing = False
+        # Entries are [number, data, resends]; doomed is how many of the
+        # oldest ones in flight will fail because an earlier one did.
+        self.in_flight = collections.deque()
+        self.in_flight_bytes = 0
+        self.resend_queue = collections.deque()
+        self.doomed = 0
+        self.next_entry = None
+        self.next_number = 0
+        self.pending_error = None
+        self.eof = False
+        self.finished = False
+        # Counters; commands_acked does not count the M110.
+        self.commands_sent = 0
+        self.commands_acked = 0
+        self.commands_resent = 0
+        self.error_responses = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def start (self):
+        self.read_io.read_start(512)
+        if self.numbered:
+            self.next_entry = self._make_entry('M110')
+        self._send_commands()
+
+    def _make_entry (self, command):
+        if not self.numbered:
+            return [None, command + '\n', 0]
+        line = 'N{} {}'.format(self.next_number, command)
+        number = self.next_number
+        self.next_number += 1
+        return [number, '{}*{}\n'.format(line, gcode_checksum(line)), 0]
+
+    def _next_entry (self):
+        if len(self.resend_queue) > 0:
+            return self.resend_queue[0]
+        if self.next_entry is None and not self.eof:
+            command = self.source()
+            if command is None:
+                self.eof = True
+            else:
+                self.next_entry = self._make_entry(command)
+        return self.next_entry
+
+    def _send_commands (self):
+        while not self.finished:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            size = len(entry[1])
+            if len(self.in_flight) > 0:
+                if self.window_bytes is not None and self.in_flight_bytes + size > self.window_bytes:
+                    break
+                if self.max_commands is not None and len(self.in_flight) >= self.max_commands:
+                    break
+            elif self.window_bytes is not None and size > self.window_bytes:
+                return self._finish('command too long for the receive buffer: {}'.format(entry[1].rstrip()))
+            if len(self.resend_queue) > 0:
+                self.resend_queue.popleft()
+                self.commands_resent += 1
+            else:
+                self.next_entry = None
+            self.in_flight.append(entry)
+            self.in_flight_bytes += size
+            self.commands_sent += 1
+            self._send(entry[1])
+        if self.eof and self.next_entry is None and len(self.resend_queue) == 0 and len(self.in_flight) == 0:
+            self._finish(None)
+
+    def _send (self, data):
+        self.write_buffer += data
+        if not self.writing:
+            self._write()
+
+    def _write (self):
+        self.writing = True
+        data = self.write_buffer
+        self.write_buffer = ''
+        self.bytes_sent += len(data)
+        self.write_io.write_start(data)
+
+    def _write_handler (self, err):
+        self.writing = False
+        if err is not None:
+            return self._finish('write error: {}'.format(err))
+        if len(self.write_buffer) > 0:
+            self._write()
+
+    def _read_handler (self, data, err):
+        if self.finished:
+            return
+        if err is not None:
+            return self._finish('read error: {}'.format(err))
+        self.bytes_received += len(data)
+        self.read_io.read_start(512)
+        lines = (self.frame + data).split('\n')
+        self.frame = lines.pop()
+        for response in lines:
+            if self.finished:
+                return
+            self._response(response.rstrip('\r'))
+        self._send_commands()
+
+    def _response (self, response):
+        if response.startswith('ok'):
+            if len(self.in_flight) == 0:
+                return self._finish('unexpected ok')
+            entry = self.in_flight.popleft()
+            self.in_flight_bytes -= len(entry[1])
+            error = self.pending_error
+            self.pending_error = None
+            if self.doomed > 0:
+                self.doomed -= 1
+            elif error is not None and self.numbered and error.startswith(ResendErrors):
+                entry[2] += 1
+                if entry[2] > self.max_resends:
+                    return self._finish('too many resends of line {}: {}'.format(entry[0], error))
+                self.resend_queue.extendleft(reversed([entry] + list(self.in_flight)))
+                self.doomed = len(self.in_flight)
+            else:
+                if entry[0] != 0:
+                    self.commands_acked += 1
+                if error is not None:
+                    self.error_responses += 1
+                    if self.response_handler is not None:
+                        self.response_handler(error)
+        elif response.startswith('Error:'):
+            self.pending_error = response
+        elif self.response_handler is not None:
+            self.response_handler(response)
+
+    def _finish (self, error):
+        if self.finished:
+            return
+        self.finished = True
+        self.finished_handler(error)
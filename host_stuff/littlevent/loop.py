@@ -1,5 +1,8 @@
 import select
 import signal
+import time
+import math
+import heapq
 import littlevent.close
 import littlevent.error
 
@@ -8,8 +11,12 @@ FdEventWrite = 2**1
 FdEventError = 2**2
 FdEventHup = 2**3
 
+# The cancelled entries are dropped from the timer heap once they are more
+# than half of it (and more than this many).
+TimerCompactMinimum = 64
+
 class Loop (littlevent.close.Obj):
-    def __init__ (self):
+    def __init__ (self, clock=time.time):
         littlevent.close.Obj.__init__(self)
         try:
             signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -19,10 +26,18 @@ class Loop (littlevent.close.Obj):
                 raise littlevent.error.Error(e)
             self.quitting = False
             self.fds = {}
-            self.pending_fds = set()
-            self.pending_lifo = []
+            self.pending_fds = {}
+            self.pending_lifo = LifoList()
+            # Heap of [when, sequence, timer] entries; timer is None once cancelled.
+            self.clock = clock
+            self.timers = []
+            self.timer_sequence = 0
+            self.cancelled_timers = 0
+            # The time of the timers being run, None between runs.
+            self.timers_now = None
             def check_close ():
                 assert len(self.pending_lifo) == 0
+                assert len(self.timers) == self.cancelled_timers
                 assert len(self.pending_fds) == 0
                 assert len(self.fds) == 0
             self.add(check_close)
@@ -34,7 +49,7 @@ class Loop (littlevent.close.Obj):
     def run (self):
         self._process_lifo()
         while not self.quitting:
-            results = self.epoll.poll()
+            results = self.epoll.poll(self._poll_timeout())
             self.pending_fds = dict((self.fds[fd_num], epoll_returned_events) for (fd_num, epoll_returned_events) in results)
             while not self.quitting and len(self.pending_fds) != 0:
                 fd_obj, epoll_returned_events = self.pending_fds.popitem()
@@ -50,12 +65,63 @@ class Loop (littlevent.close.Obj):
                 if returned_events != 0:
                     fd_obj.handler(returned_events)
                     self._process_lifo()
+            self._process_timers()
         return self.return_value
     
     def quit (self, return_value=0):
         self.quitting = True
         self.return_value = return_value
     
+    def time (self):
+        return self.clock()
+    
+    def call_at (self, when, handler):
+        timer = Timer(self, handler)
+        timer.start_at(when)
+        return timer
+    
+    def call_later (self, delay, handler):
+        timer = Timer(self, handler)
+        timer.start(delay)
+        return timer
+    
+    def _poll_timeout (self):
+        while len(self.timers) != 0 and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+            self.cancelled_timers -= 1
+        if len(self.timers) == 0:
+            return -1
+        # epoll truncates to milliseconds; round up so as not to spin.
+        return max(0.0, math.ceil((self.timers[0][0] - self.clock()) * 1000.0) / 1000.0)
+    
+    def _process_timers (self):
+        # Timers started by the handlers wait for the next iteration, even
+        # if already due, so that a zero delay cannot starve the fds. Their
+        # deadlines are no earlier than now (see Timer.start_at), so they
+        # come after the due timers started before, and cannot hold those up.
+        now = self.clock()
+        sequence_end = self.timer_sequence
+        self.timers_now = now
+        try:
+            while not self.quitting and len(self.timers) != 0 and self.timers[0][0] <= now and self.timers[0][1] < sequence_end:
+                when, sequence, timer = heapq.heappop(self.timers)
+                if timer is None:
+                    self.cancelled_timers -= 1
+                    continue
+                timer.entry = None
+                timer.handler()
+                self._process_lifo()
+        finally:
+            self.timers_now = None
+    
+    def _cancel_timer_entry (self, entry):
+        entry[2] = None
+        self.cancelled_timers += 1
+        if self.cancelled_timers > TimerCompactMinimum and 2 * self.cancelled_timers > len(self.timers):
+            self.timers = [e for e in self.timers if e[2] is not None]
+            heapq.heapify(self.timers)
+            self.cancelled_timers = 0
+    
     def _process_lifo (self):
         while not self.quitting and len(self.pending_lifo) != 0:
             lifo_event = self.pending_lifo.pop()
@@ -63,12 +129,47 @@ class Loop (littlevent.close.Obj):
             lifo_event.pending = False
             lifo_event.handler()
 
+class LifoList (object):
+    # The pending LifoEvents, as a doubly linked list through their
+    # lifo_prev and lifo_next, with the list itself at both ends. All
+    # operations are O(1); pop() takes the last appended event.
+    def __init__ (self):
+        self.lifo_prev = self
+        self.lifo_next = self
+        self.count = 0
+    
+    def __len__ (self):
+        return self.count
+    
+    def append (self, lifo_event):
+        last = self.lifo_prev
+        lifo_event.lifo_prev = last
+        lifo_event.lifo_next = self
+        last.lifo_next = lifo_event
+        self.lifo_prev = lifo_event
+        self.count += 1
+    
+    def remove (self, lifo_event):
+        lifo_event.lifo_prev.lifo_next = lifo_event.lifo_next
+        lifo_event.lifo_next.lifo_prev = lifo_event.lifo_prev
+        lifo_event.lifo_prev = None
+        lifo_event.lifo_next = None
+        self.count -= 1
+    
+    def pop (self):
+        assert self.count != 0
+        lifo_event = self.lifo_prev
+        self.remove(lifo_event)
+        return lifo_event
+
 class LifoEvent (littlevent.close.Obj):
     def __init__ (self, loop, handler):
         self.loop = loop
         self.handler = handler
         littlevent.close.Obj.__init__(self)
         self.pending = False
+        self.lifo_prev = None
+        self.lifo_next = None
         def on_close ():
             if self.pending:
                 self.loop.pending_lifo.remove(self)
@@ -85,6 +186,40 @@ class LifoEvent (littlevent.close.Obj):
             self.loop.pending_lifo.remove(self)
             self.pending = False
 
+class Timer (littlevent.close.Obj):
+    def __init__ (self, loop, handler):
+        self.loop = loop
+        self.handler = handler
+        littlevent.close.Obj.__init__(self)
+        self.entry = None
+        self.add(self.cancel)
+    
+    def pending (self):
+        return self.entry is not None
+    
+    def when (self):
+        return None if self.entry is None else self.entry[0]
+    
+    def start_at (self, when):
+        # Restarting a pending timer cancels the previous time. A time
+        # already past, given while the timers are being run, is taken as
+        # the time they are run for.
+        self.cancel()
+        timers_now = self.loop.timers_now
+        if timers_now is not None and when < timers_now:
+            when = timers_now
+        self.entry = [when, self.loop.timer_sequence, self]
+        self.loop.timer_sequence += 1
+        heapq.heappush(self.loop.timers, self.entry)
+    
+    def start (self, delay):
+        self.start_at(self.loop.clock() + delay)
+    
+    def cancel (self):
+        if self.entry is not None:
+            self.loop._cancel_timer_entry(self.entry)
+            self.entry = None
+
 class FileDescriptor (littlevent.close.Obj):
     def __init__ (self, loop, fd_num, handler):
         assert fd_num not in loop.fds
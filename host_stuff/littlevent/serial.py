@@ -1,23 +1,47 @@
 import os
-import tty
+import errno
+import fcntl
+import struct
 import termios
 import littlevent.close
+import littlevent.error
 import littlevent.loop
 import littlevent.fd_io
 
+# Port settings: raw 8N1 at the given baud rate, with optional hardware
+# (rtscts) or software (xonxoff) flow control, VMIN/VTIME for the reads,
+# and the driver's low latency mode where there is one. Baud rates which
+# termios has no constant for (such as 250000 or 1000000) are set through
+# the Linux termios2 interface with BOTHER.
+
+FlowControlNone = 'none'
+FlowControlRtsCts = 'rtscts'
+FlowControlXonXoff = 'xonxoff'
+
+# From the Linux headers (asm-generic), for struct termios2 and serial_struct.
+_TCGETS2 = 0x802C542A
+_TCSETS2 = 0x402C542B
+_CBAUD = 0o010017
+_BOTHER = 0o010000
+_Termios2 = struct.Struct('IIIIB19sII')
+_SerialStructSize = 72
+_SerialStructFlags = struct.Struct('i')
+_SerialStructFlagsOffset = 16
+_AsyncLowLatency = 1 << 13
+
+_BaudConstants = dict((int(name[1:]), getattr(termios, name)) for name in dir(termios) if name.startswith('B') and name[1:].isdigit())
+
 class Serial (littlevent.close.Obj):
-    def __init__ (self, loop, device_path, baud_rate, error_handler):
+    def __init__ (self, loop, device_path, baud_rate, error_handler, flow_control=FlowControlNone, vmin=1, vtime=0, low_latency=True):
         littlevent.close.Obj.__init__(self)
         try:
             try:
-                fd_num = os.open(device_path, os.O_RDWR)
+                fd_num = os.open(device_path, os.O_RDWR | os.O_NOCTTY)
             except OSError as e:
                 raise littlevent.error.Error(e)
             self.fd_io = self.add(littlevent.fd_io.FileDescriptor(loop, fd_num, True, error_handler))
-            try:
-                tty.setraw(fd_num)
-            except termios.error as e:
-                raise littlevent.error.Error(e)
+            configure(fd_num, baud_rate, flow_control, vmin, vtime)
+            self.low_latency = set_low_latency(fd_num) if low_latency else False
         
         except littlevent.error.Error:
             self.close()
@@ -28,3 +52,59 @@ class Serial (littlevent.close.Obj):
     
     def write_io (self):
         return self.fd_io
+
+def configure (fd_num, baud_rate, flow_control=FlowControlNone, vmin=1, vtime=0):
+    try:
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd_num)
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR | termios.IGNCR |
+                   termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | termios.CRTSCTS)
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+        if flow_control == FlowControlRtsCts:
+            cflag |= termios.CRTSCTS
+        elif flow_control == FlowControlXonXoff:
+            iflag |= termios.IXON | termios.IXOFF
+        elif flow_control != FlowControlNone:
+            raise littlevent.error.Error('Unknown flow control: {}'.format(flow_control))
+        cc[termios.VMIN] = vmin
+        cc[termios.VTIME] = vtime
+        if baud_rate in _BaudConstants:
+            ispeed = ospeed = _BaudConstants[baud_rate]
+        termios.tcsetattr(fd_num, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+        if baud_rate not in _BaudConstants:
+            _set_custom_baud_rate(fd_num, baud_rate)
+        termios.tcflush(fd_num, termios.TCIOFLUSH)
+    except (termios.error, IOError) as e:
+        raise littlevent.error.Error(e)
+
+def get_baud_rate (fd_num):
+    # The actual output speed, also for custom rates.
+    try:
+        data = fcntl.ioctl(fd_num, _TCGETS2, '\0' * _Termios2.size)
+    except IOError as e:
+        raise littlevent.error.Error(e)
+    return _Termios2.unpack(data)[7]
+
+def set_low_latency (fd_num):
+    # Returns whether the driver took the low latency flag; ptys and many
+    # USB serial drivers have no such setting.
+    try:
+        data = bytearray(fcntl.ioctl(fd_num, termios.TIOCGSERIAL, '\0' * _SerialStructSize))
+        flags = _SerialStructFlags.unpack_from(data, _SerialStructFlagsOffset)[0]
+        _SerialStructFlags.pack_into(data, _SerialStructFlagsOffset, flags | _AsyncLowLatency)
+        fcntl.ioctl(fd_num, termios.TIOCSSERIAL, str(data))
+    except IOError as e:
+        if e.errno in (errno.ENOTTY, errno.EINVAL, errno.EPERM):
+            return False
+        raise littlevent.error.Error(e)
+    return True
+
+def _set_custom_baud_rate (fd_num, baud_rate):
+    data = fcntl.ioctl(fd_num, _TCGETS2, '\0' * _Termios2.size)
+    iflag, oflag, cflag, lflag, line, cc, ispeed, ospeed = _Termios2.unpack(data)
+    cflag = (cflag & ~_CBAUD) | _BOTHER
+    fcntl.ioctl(fd_num, _TCSETS2, _Termios2.pack(iflag, oflag, cflag, lflag, line, cc, baud_rate, baud_rate))
+    if get_baud_rate(fd_num) != baud_rate:
+        raise littlevent.error.Error('Baud rate {} not supported by the port.'.format(baud_rate))
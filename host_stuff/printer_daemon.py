@@ -0,0 +1,220 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+import littlevent.close
+import littlevent.error
+import littlevent.loop
+import littlevent.fd_io
+import littlevent.serial
+import gcode_sender
+
+# Stream g-code to many printers from one process, with one loop driving
+# all the serial ports. Each printer has its own flow control, through a
+# GcodeSender: by default a command is sent once the previous one has been
+# answered with "ok", or with the firmware's receive buffer size known, as
+# many as fit into it. A slow or failed printer does not hold up the others.
+
+class Printer (littlevent.close.Obj):
+    def __init__ (self, loop, name, port, baud_rate, gcode_file_name, finished_handler, window_bytes=None, max_commands=1):
+        littlevent.close.Obj.__init__(self)
+        self.serial = None
+        try:
+            try:
+                self.gcode_file = self.add(open(gcode_file_name, 'r'))
+            except IOError as e:
+                raise littlevent.error.Error(e)
+            self.serial = littlevent.serial.Serial(loop, port, baud_rate, self._error_handler)
+            self.add(self._close_serial)
+        except littlevent.error.Error:
+            self.close()
+            raise
+        self.loop = loop
+        self.name = name
+        self.finished_handler = finished_handler
+        self.sender = gcode_sender.GcodeSender(self.serial.read_io(), self.serial.write_io(), self._next_command, self._finish,
+            window_bytes, max_commands, response_handler=self._response_handler)
+        self.finished = False
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+
+    def start (self):
+        self.start_time = self.loop.time()
+        self.sender.start()
+
+    def seconds (self):
+        if self.start_time is None:
+            return 0.0
+        return (self.loop.time() if self.end_time is None else self.end_time) - self.start_time
+
+    def stats (self):
+        seconds = self.seconds()
+        sender = self.sender
+        return {
+            'name': self.name,
+            'commandsSent': sender.commands_sent,
+            'commandsAcked': sender.commands_acked,
+            'commandsResent': sender.commands_resent,
+            'errorResponses': sender.error_responses,
+            'bytesSent': sender.bytes_sent,
+            'bytesReceived': sender.bytes_received,
+            'seconds': seconds,
+            'commandsPerSecond': sender.commands_acked / seconds if seconds > 0 else 0.0,
+            'finished': self.finished,
+            'error': None if self.error is None else str(self.error),
+        }
+
+    def _close_serial (self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+
+    def _next_command (self):
+        # The next non-empty line of the file, without its comment.
+        for line in self.gcode_file:
+            command = line.split(';', 1)[0].strip()
+            if len(command) > 0:
+                return command
+        return None
+
+    def _response_handler (self, response):
+        if response.startswith('Error:') or response.startswith('!!'):
+            print('{}: {}'.format(self.name, response))
+
+    def _error_handler (self, returned_events):
+        self._finish('unexpected event')
+
+    def _finish (self, error):
+        if self.finished:
+            return
+        self.finished = True
+        self.error = error
+        self.sender.finished = True
+        self.end_time = self.loop.time()
+        self._close_serial()
+        self.finished_handler(self)
+
+class Daemon (littlevent.close.Obj):
+    # Runs the printers given as (name, port, baud rate, g-code file) on the
+    # loop, printing the counters every stats_interval seconds (if not None).
+    # The loop returns 0 when all printers have finished without errors.
+    def __init__ (self, loop, printer_specs, stats_interval, window_bytes=None, max_commands=1):
+        littlevent.close.Obj.__init__(self)
+        self.loop = loop
+        self.printers = []
+        try:
+            for (name, port, baud_rate, gcode_file_name) in printer_specs:
+                self.printers.append(self.add(Printer(loop, name, port, baud_rate, gcode_file_name, self._printer_finished, window_bytes, max_commands)))
+            self.stats_timer = self.add(littlevent.loop.Timer(loop, self._stats_timer_handler))
+        except littlevent.error.Error:
+            self.close()
+            raise
+        self.stats_interval = stats_interval
+        self.unfinished = len(self.printers)
+        self.start_time = None
+
+    def start (self):
+        self.start_time = self.loop.time()
+        for printer in self.printers:
+            printer.start()
+        if self.stats_interval is not None and self.unfinished > 0:
+            self.stats_timer.start(self.stats_interval)
+
+    def stats (self):
+        printers = [printer.stats() for printer in self.printers]
+        seconds = self.loop.time() - self.start_time
+        acked = sum(p['commandsAcked'] for p in printers)
+        return {
+            'printers': printers,
+            'commandsSent': sum(p['commandsSent'] for p in printers),
+            'commandsAcked': acked,
+            'commandsResent': sum(p['commandsResent'] for p in printers),
+            'bytesSent': sum(p['bytesSent'] for p in printers),
+            'bytesReceived': sum(p['bytesReceived'] for p in printers),
+            'seconds': seconds,
+            'commandsPerSecond': acked / seconds if seconds > 0 else 0.0,
+        }
+
+    def format_stats (self):
+        stats = self.stats()
+        rows = []
+        for p in stats['printers']:
+            state = 'failed: {}'.format(p['error']) if p['error'] is not None else ('done' if p['finished'] else 'running')
+            rows.append('{:<16} {:>9} cmds {:>10.1f} cmd/s {:>10} B out {:>10} B in  {}'.format(
+                p['name'], p['commandsAcked'], p['commandsPerSecond'], p['bytesSent'], p['bytesReceived'], state))
+        rows.append('{:<16} {:>9} cmds {:>10.1f} cmd/s {:>10} B out {:>10} B in  {:.1f} s'.format(
+            'total', stats['commandsAcked'], stats['commandsPerSecond'], stats['bytesSent'], stats['bytesReceived'], stats['seconds']))
+        return '\n'.join(rows)
+
+    def _stats_timer_handler (self):
+        print(self.format_stats())
+        sys.stdout.flush()
+        self.stats_timer.start(self.stats_interval)
+
+    def _printer_finished (self, printer):
+        if printer.error is not None:
+            print('{}: {}'.format(printer.name, printer.error))
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.stats_timer.cancel()
+            failed = any(p.error is not None for p in self.printers)
+            self.loop.quit(1 if failed else 0)
+
+def main ():
+    parser = argparse.ArgumentParser(description='Stream g-code to many printers from one process.')
+    parser.add_argument('--printer', nargs=3, action='append', required=True, metavar=('Port', 'Baud', 'GcodeFile'), help='A printer and the file to send to it.')
+    parser.add_argument('--board', metavar='BoardMainFile', help='Send as many commands as fit into the receive buffer of this board\'s firmware.')
+    parser.add_argument('--recv-buffer-exp', type=int, metavar='N', help='Send as many commands as fit into a receive buffer of 2**N-1 bytes.')
+    parser.add_argument('--max-in-flight', type=int, metavar='K', help='Keep at most K commands in flight (1 to stop and wait).')
+    parser.add_argument('--stats-interval', type=float, default=5.0, help='Seconds between counter reports (0 for none).')
+    parser.add_argument('--stats-json', metavar='StatsFile', help='Write the final counters as JSON (- for standard output).')
+    args = parser.parse_args()
+
+    recv_buffer_exp = args.recv_buffer_exp
+    if args.board is not None:
+        if recv_buffer_exp is not None:
+            parser.error('--board and --recv-buffer-exp cannot be used together')
+        try:
+            recv_buffer_exp = gcode_sender.read_recv_buffer_size_exp(args.board)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    window_bytes = None if recv_buffer_exp is None else 2**recv_buffer_exp - 1
+    max_commands = args.max_in_flight if args.max_in_flight is not None or window_bytes is not None else 1
+    if max_commands is not None and max_commands < 1:
+        parser.error('--max-in-flight must be at least 1')
+
+    specs = []
+    for (port, baud, gcode_file_name) in args.printer:
+        try:
+            baud_rate = int(baud)
+        except ValueError:
+            parser.error('invalid baud rate: {}'.format(baud))
+        specs.append((port, port, baud_rate, gcode_file_name))
+
+    program = littlevent.close.Obj()
+    try:
+        loop = program.add(littlevent.loop.Loop())
+        daemon = program.add(Daemon(loop, specs, args.stats_interval if args.stats_interval > 0 else None, window_bytes, max_commands))
+    except littlevent.error.Error as e:
+        program.close()
+        print('ERROR: {}'.format(e))
+        sys.exit(1)
+
+    daemon.start()
+    ret = loop.run() if daemon.unfinished > 0 else 0
+    print(daemon.format_stats())
+    if args.stats_json is not None:
+        text = json.dumps(daemon.stats(), indent=2, sort_keys=True)
+        if args.stats_json == '-':
+            print(text)
+        else:
+            with open(args.stats_json, 'w') as f:
+                f.write(text + '\n')
+    program.close()
+    sys.exit(ret)
+
+if __name__ == '__main__':
+    main()
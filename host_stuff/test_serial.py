@@ -0,0 +1,137 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import os
+import sys
+import argparse
+import termios
+import littlevent.close
+import littlevent.error
+import littlevent.loop
+import littlevent.fd_io
+import littlevent.serial
+
+# Self-test of littlevent.serial.Serial: checks that the settings were
+# applied and measures the throughput of data written through the port.
+# By default the port is the slave side of a pty pair, read back on the
+# master side; ptys do not limit the speed to the baud rate, so this shows
+# the overhead of the host side. With --port, a real port is used, which
+# needs a loopback plug (TX wired to RX), and the throughput should come
+# close to the baud rate / 10 bytes per second.
+
+class Program (littlevent.close.Obj):
+    def __init__ (self, args):
+        littlevent.close.Obj.__init__(self)
+        try:
+            self.loop = self.add(littlevent.loop.Loop())
+            if args.port is None:
+                try:
+                    master_fd, slave_fd = os.openpty()
+                except OSError as e:
+                    raise littlevent.error.Error(e)
+                self.add(lambda: os.close(slave_fd))
+                self.read_io = self.add(littlevent.fd_io.FileDescriptor(self.loop, master_fd, True, self._error_handler))
+                port = os.ttyname(slave_fd)
+            else:
+                port = args.port
+            self.serial = self.add(littlevent.serial.Serial(self.loop, port, args.baud, self._error_handler, args.flow_control, args.vmin, args.vtime))
+            if args.port is not None:
+                self.read_io = self.serial.read_io()
+        except littlevent.error.Error:
+            self.close()
+            raise
+        self.args = args
+        self.port = port
+        self.data = ''.join(chr(32 + i % 95) for i in range(args.bytes))
+        self.write_pos = 0
+        self.read_pos = 0
+        self.read_io.read_set_handler(self._read_handler)
+        self.serial.write_io().write_set_handler(self._write_handler)
+
+    def check_settings (self):
+        fd_num = self.serial.write_io().fd_num
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd_num)
+        baud_rate = littlevent.serial.get_baud_rate(fd_num)
+        print('Port {}: {} baud, low latency {}.'.format(self.port, baud_rate, 'on' if self.serial.low_latency else 'not available'))
+        problems = []
+        if baud_rate != self.args.baud:
+            problems.append('baud rate is {}'.format(baud_rate))
+        if (lflag & (termios.ICANON | termios.ECHO)) != 0 or (oflag & termios.OPOST) != 0:
+            problems.append('not in raw mode')
+        if (cflag & termios.CSIZE) != termios.CS8 or (cflag & (termios.PARENB | termios.CSTOPB)) != 0:
+            problems.append('not 8N1')
+        if bool(cflag & termios.CRTSCTS) != (self.args.flow_control == littlevent.serial.FlowControlRtsCts):
+            problems.append('wrong RTS/CTS setting')
+        if bool(iflag & termios.IXON) != (self.args.flow_control == littlevent.serial.FlowControlXonXoff):
+            problems.append('wrong XON/XOFF setting')
+        if cc[termios.VMIN] != self.args.vmin or cc[termios.VTIME] != self.args.vtime:
+            problems.append('wrong VMIN/VTIME')
+        for problem in problems:
+            print('ERROR: {}'.format(problem))
+        return len(problems) == 0
+
+    def run (self):
+        self.start_time = self.loop.time()
+        self.read_io.read_start(4096)
+        self._write()
+        ret = self.loop.run()
+        if ret == 0:
+            seconds = self.end_time - self.start_time
+            rate = len(self.data) / seconds
+            print('Transferred {} bytes in {:.3f} seconds, {:.0f} bytes/s ({:.1f}% of {} baud).'.format(
+                len(self.data), seconds, rate, rate * 1000.0 / self.args.baud, self.args.baud))
+        return ret
+
+    def _write (self):
+        chunk = self.data[self.write_pos:self.write_pos + 4096]
+        self.write_pos += len(chunk)
+        self.serial.write_io().write_start(chunk)
+
+    def _write_handler (self, err):
+        if err is not None:
+            print('ERROR: write error: {}'.format(err))
+            return self.loop.quit(1)
+        if self.write_pos < len(self.data):
+            self._write()
+
+    def _read_handler (self, data, err):
+        if err is not None:
+            print('ERROR: read error: {}'.format(err))
+            return self.loop.quit(1)
+        if data != self.data[self.read_pos:self.read_pos + len(data)]:
+            print('ERROR: data corrupted at byte {}'.format(self.read_pos))
+            return self.loop.quit(1)
+        self.read_pos += len(data)
+        if self.read_pos == len(self.data):
+            self.end_time = self.loop.time()
+            return self.loop.quit(0)
+        self.read_io.read_start(4096)
+
+    def _error_handler (self, returned_events):
+        print('ERROR: unexpected event.')
+        self.loop.quit(1)
+
+def main ():
+    parser = argparse.ArgumentParser(description='Check serial port settings and measure throughput.')
+    parser.add_argument('--port', help='Serial port with a loopback plug (default: a pty pair).')
+    parser.add_argument('--baud', type=int, default=250000, help='Baud rate.')
+    parser.add_argument('--flow-control', choices=[littlevent.serial.FlowControlNone, littlevent.serial.FlowControlRtsCts, littlevent.serial.FlowControlXonXoff],
+                        default=littlevent.serial.FlowControlNone, help='Flow control.')
+    parser.add_argument('--vmin', type=int, default=1, help='VMIN.')
+    parser.add_argument('--vtime', type=int, default=0, help='VTIME, in tenths of a second.')
+    parser.add_argument('--bytes', type=int, default=1000000, help='Number of bytes to transfer.')
+    args = parser.parse_args()
+
+    try:
+        p = Program(args)
+    except littlevent.error.Error as e:
+        print('ERROR: {}'.format(e))
+        sys.exit(1)
+    ret = 0 if p.check_settings() else 1
+    if ret == 0:
+        ret = p.run()
+    p.close()
+    sys.exit(ret)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python2.7 -B
+
+from __future__ import print_function
+import os
+import sys
+import signal
+import argparse
+import littlevent.close
+import littlevent.loop
+
+# Self-test of the littlevent.loop timers, on a fake clock which only moves
+# when a case moves it, so that nothing waits for real time: the order in
+# which due timers fire (by deadline, and by start order for equal ones),
+# cancelling and restarting, the compaction of the heap after many cancels,
+# and that a timer restarted from its own handler does not keep the loop
+# from the fds. A case that hangs is stopped by a watchdog alarm.
+
+class FakeClock (object):
+    def __init__ (self, now=1000.0):
+        self.now = now
+
+    def __call__ (self):
+        return self.now
+
+class Case (littlevent.close.Obj):
+    # A loop on a fake clock, recording which timers fired in fired.
+    def __init__ (self):
+        littlevent.close.Obj.__init__(self)
+        self.clock = FakeClock()
+        self.loop = self.add(littlevent.loop.Loop(clock=self.clock))
+        self.fired = []
+        self.problems = []
+
+    def timer (self, name, when=None):
+        timer = self.add(littlevent.loop.Timer(self.loop, lambda: self.fired.append(name)))
+        if when is not None:
+            timer.start_at(when)
+        return timer
+
+    def run_until (self, when):
+        # Moves the clock to when and runs the timers due by then. The one
+        # which quits is started last, so it fires after all of them.
+        self.add(littlevent.loop.Timer(self.loop, lambda: self.loop.quit(0))).start_at(when)
+        self.clock.now = when
+        return self.loop.run()
+
+    def expect (self, what, value, expected):
+        if value != expected:
+            self.problems.append('{}: {!r}, expected {!r}'.format(what, value, expected))
+
+def case_order ():
+    case = Case()
+    now = case.clock.now
+    for delay in (5, 1, 4, 2, 3):
+        case.timer(delay, now + delay)
+    later = case.timer('later', now + 20)
+    case.run_until(now + 10)
+    case.expect('order', case.fired, [1, 2, 3, 4, 5])
+    case.expect('timer not yet due is pending', later.when(), now + 20)
+    return case
+
+def case_equal_deadlines ():
+    case = Case()
+    now = case.clock.now
+    timers = [case.timer(i, now + 1) for i in range(10)]
+    # Restarting at the same deadline goes after the ones started before.
+    timers[3].start_at(now + 1)
+    case.run_until(now + 1)
+    case.expect('order', case.fired, [0, 1, 2, 4, 5, 6, 7, 8, 9, 3])
+    return case
+
+def case_cancel_restart ():
+    case = Case()
+    now = case.clock.now
+    a = case.timer('a', now + 1)
+    b = case.timer('b', now + 2)
+    c = case.timer('c', now + 3)
+    d = case.timer('d', now + 4)
+    b.cancel()
+    c.start_at(now + 0.5)
+    a.start_at(now + 3.5)
+    d.cancel()
+    d.start(2)
+    case.expect('cancelled timer', (b.pending(), b.when()), (False, None))
+    case.expect('restarted timer', (c.pending(), c.when()), (True, now + 0.5))
+    case.run_until(now + 10)
+    case.expect('order', case.fired, ['c', 'd', 'a'])
+    case.expect('fired timer', (a.pending(), a.when()), (False, None))
+    return case
+
+def case_compaction ():
+    case = Case()
+    now = case.clock.now
+    loop = case.loop
+    timers = [case.timer(i, now + 1 + i * 0.001) for i in range(1000)]
+    for (i, timer) in enumerate(timers):
+        if i % 10 != 0:
+            timer.cancel()
+    live = len([entry for entry in loop.timers if entry[2] is not None])
+    case.expect('live entries', live, 100)
+    case.expect('cancelled entries', loop.cancelled_timers, len(loop.timers) - live)
+    if len(loop.timers) > max(2 * live, live + littlevent.loop.TimerCompactMinimum):
+        case.problems.append('heap not compacted: {} entries for {} timers'.format(len(loop.timers), live))
+    case.run_until(now + 10)
+    case.expect('order', case.fired, range(0, 1000, 10))
+    return case
+
+def case_no_starvation ():
+    # Two timers restart themselves, already due, from their handlers, and
+    # the third time one fires it makes a pipe readable; the fd must get
+    # its turn on the next iteration instead of the timers firing forever.
+    case = Case()
+    loop = case.loop
+    read_fd, write_fd = os.pipe()
+    case.add(lambda: os.close(read_fd))
+    case.add(lambda: os.close(write_fd))
+    counts = {'zero': 0, 'past': 0}
+    fd_counts = []
+    def zero_handler ():
+        counts['zero'] += 1
+        if counts['zero'] == 3:
+            os.write(write_fd, 'x')
+        zero.start(0)
+    def past_handler ():
+        counts['past'] += 1
+        past.start_at(case.clock.now - 1)
+    def fd_handler (returned_events):
+        os.read(read_fd, 1)
+        fd_counts.append(dict(counts))
+        loop.quit(0)
+    fd = case.add(littlevent.loop.FileDescriptor(loop, read_fd, fd_handler))
+    fd.set_events(littlevent.loop.FdEventRead)
+    zero = case.add(littlevent.loop.Timer(loop, zero_handler))
+    past = case.add(littlevent.loop.Timer(loop, past_handler))
+    zero.start(0)
+    past.start(0)
+    loop.run()
+    case.expect('fired before the fd', fd_counts, [{'zero': 3, 'past': 3}])
+    return case
+
+Cases = [
+    ('order', case_order),
+    ('equal deadlines', case_equal_deadlines),
+    ('cancel and restart', case_cancel_restart),
+    ('compaction', case_compaction),
+    ('no starvation', case_no_starvation),
+]
+
+def main ():
+    parser = argparse.ArgumentParser(description='Check the timers of the littlevent loop.')
+    parser.add_argument('--timeout', type=int, default=10, help='Seconds before a case counts as hung.')
+    args = parser.parse_args()
+
+    def watchdog (signum, frame):
+        print('ERROR: timed out')
+        sys.stdout.flush()
+        os._exit(1)
+    signal.signal(signal.SIGALRM, watchdog)
+
+    ret = 0
+    for (name, run_case) in Cases:
+        signal.alarm(args.timeout)
+        case = run_case()
+        signal.alarm(0)
+        case.close()
+        for problem in case.problems:
+            print('ERROR: {}: {}'.format(name, problem))
+        if len(case.problems) != 0:
+            ret = 1
+        else:
+            print('ok {}'.format(name))
+    sys.exit(ret)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2.7
+
+# Regression check for the parallel host tools: a syntax error in one chunk,
+# while other chunks are still being worked on, must make the run fail with
+# the error instead of hanging, and so must a consumer of DeTool's output
+# which stops reading early. The hang was intermittent, so each case is run
+# a number of times, each in a child process with a timeout.
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EncoderChild = '''
+import io, sys
+sys.path.insert(0, {root!r})
+import aprinter_encode
+with open({input!r}, 'rb') as input_file:
+    try:
+        aprinter_encode.encode_stream_parallel(input_file, io.BytesIO(), 3, chunk_size={chunk_size})
+    except aprinter_encode.GcodeSyntaxError as e:
+        print(e)
+        sys.exit(1)
+'''
+
+DeToolChild = '''
+import sys
+sys.path.insert(0, {root!r})
+import DeTool
+tool = {{'name':'E', 'offsets':{{'X':0.0, 'Y':0.0, 'Z':0.0}}, 'fan':''}}
+config = DeTool.DeToolConfig({{0:tool}}, 120.0)
+output = DeTool.process_file_parallel({input!r}, DeTool.DeTool(config), 3, chunkSize={chunk_size})
+try:
+    for i, text in enumerate(output):
+        if i == {stop_after}:
+            output.close()
+            print('stopped')
+            sys.exit(2)
+except Exception as e:
+    print(e)
+    sys.exit(1)
+'''
+
+def write_input(file_name, num_lines, bad_line):
+    with open(file_name, 'w') as f:
+        for i in range(1, num_lines + 1):
+            if i == bad_line:
+                f.write('G1 X!!bad\n')
+            else:
+                f.write('G1 X{:.3f} Y{:.3f} E{:.5f}\n'.format(i % 200 * 0.5, i % 170 * 0.5, i * 0.01))
+
+def run_child(command, timeout):
+    # Returns (exit code, output), or None if it did not exit in time.
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while process.poll() is None:
+        if time.time() >= deadline:
+            process.kill()
+            process.wait()
+            return None
+        time.sleep(0.05)
+    return (process.returncode, process.stdout.read())
+
+def check(name, command, expected_code, expected, runs, timeout):
+    for i in range(runs):
+        result = run_child(command, timeout)
+        if result is None:
+            print('FAIL {}: run {} did not exit within {} seconds'.format(name, i + 1, timeout))
+            return False
+        returncode, output = result
+        if returncode != expected_code or expected not in output:
+            print('FAIL {}: run {} exited with {}: {}'.format(name, i + 1, returncode, output.strip()))
+            return False
+    print('ok {} ({} runs)'.format(name, runs))
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that parallel runs exit on syntax errors.')
+    parser.add_argument('--runs', type=int, default=10, help='Runs of each case.')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Seconds before a run counts as hung.')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_file_name = os.path.join(work_dir, 'bad.gcode')
+        write_input(input_file_name, 100000, 20001)
+        ok = True
+        for chunk_size in (50000, 500000):
+            command = [sys.executable, '-c', EncoderChild.format(root=Root, input=input_file_name, chunk_size=chunk_size)]
+            ok = check('encoder, chunk size {}'.format(chunk_size), command, 1, 'line 20001:', args.runs, args.timeout) and ok
+        for chunk_size in (200000, 2000000):
+            command = [sys.executable, '-c', DeToolChild.format(root=Root, input=input_file_name, chunk_size=chunk_size, stop_after=-1)]
+            ok = check('DeTool, chunk size {}'.format(chunk_size), command, 1, 'could not convert', args.runs, args.timeout) and ok
+        good_file_name = os.path.join(work_dir, 'good.gcode')
+        write_input(good_file_name, 100000, None)
+        command = [sys.executable, '-c', DeToolChild.format(root=Root, input=good_file_name, chunk_size=200000, stop_after=2)]
+        ok = check('DeTool, output not read to the end', command, 2, 'stopped', args.runs, args.timeout) and ok
+    finally:
+        shutil.rmtree(work_dir)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()